@@ -3,6 +3,7 @@ API для AI-агента: отправка писем, чтение входя
 Запуск: uvicorn app:app --host 0.0.0.0 --port 8000
 """
 
+import asyncio
 import csv
 import io
 import logging
@@ -13,11 +14,12 @@ from pathlib import Path
 from fastapi import Body, FastAPI, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
+from pydantic_core import to_json
 
 from ai_config import AIConfig
 from ai_embedding import text_to_vector_384
 from ai_pipeline import run_ai_pipeline
-from db import init_db
+from db import close_pool, init_db, write_batch
 from email_service import check_connection, fetch_recent_emails, fetch_recent_emails_sent, send_email
 from repositories import (
     create_email_log,
@@ -25,7 +27,6 @@ from repositories import (
     create_or_update_ticket_from_email,
     fill_knowledge_base_embeddings,
     get_ticket,
-    incoming_email_already_processed,
     list_tickets,
     log_ai_run,
     mark_ticket_sent,
@@ -35,10 +36,12 @@ from repositories import (
 )
 from qwen_service import ask_qwen
 from schemas import (
-    KnowledgeBaseEntry,
+    KB_ENTRIES_ADAPTER,
     KnowledgeBaseSearchResponse,
     KbAskRequest,
     KbAskResponse,
+    ProcessBatchEmailsRequest,
+    ProcessBatchEmailsResponse,
     ProcessDemoRequest,
     ProcessLatestEmailRequest,
     ProcessLatestEmailResponse,
@@ -119,6 +122,11 @@ def startup_event():
     _seed_demo_tickets_if_empty()
 
 
+@app.on_event("shutdown")
+def shutdown_event():
+    close_pool()
+
+
 def _parse_confidence_from_reply(reply: str) -> tuple[str, int]:
     """
     Извлекает из конца ответа строку вида CONFIDENCE: N (0-100).
@@ -283,8 +291,7 @@ def _run_ai_stub(email_item: dict) -> dict:
     }
 
 
-def _ingest_single_email(email_item: dict) -> int:
-    ticket_id, created = create_or_update_ticket_from_email(email_item)
+def _log_incoming_email(ticket_id: int, email_item: dict, created: bool) -> None:
     create_email_log(
         ticket_id=ticket_id,
         raw_from=str(email_item.get("from_addr") or ""),
@@ -296,6 +303,11 @@ def _ingest_single_email(email_item: dict) -> int:
         direction="incoming",
     )
     logger.info("Email ingested into ticket_id=%s created=%s", ticket_id, created)
+
+
+def _ingest_single_email(email_item: dict) -> int:
+    ticket_id, created = create_or_update_ticket_from_email(email_item)
+    _log_incoming_email(ticket_id, email_item, created)
     return ticket_id
 
 
@@ -313,30 +325,47 @@ def _extract_keywords(text: str, limit: int = 8) -> list[str]:
     return deduped
 
 
-def _process_email_to_ticket(email_item: dict) -> tuple[int, dict]:
-    ticket_id = _ingest_single_email(email_item)
+def _process_email_to_ticket(email_item: dict) -> tuple[int, dict] | None:
+    """
+    Письмо → тикет → ИИ. None, если письмо уже было принято раньше: ИИ не перезапускаем,
+    иначе set_ai_result вернул бы тикет в 'drafted' и затёр ответ оператора.
+    """
+    ticket_id, created = create_or_update_ticket_from_email(email_item)
+    if not created:
+        logger.info("Batch skip: письмо уже обработано (message_id=%s)", (email_item.get("message_id") or "")[:50])
+        return None
+    _log_incoming_email(ticket_id, email_item, created)
     ai_result = run_ai_pipeline(email_item)
-    set_ai_result(ticket_id, ai_result)
-    log_ai_run(
-        ticket_id=ticket_id,
-        payload={
-            "pipeline_version": ai_result.get("pipeline_version"),
-            "analyzer_model": ai_result.get("analyzer_model"),
-            "generator_model": ai_result.get("generator_model"),
-            "retriever_top_k": len(ai_result.get("sources", [])),
-            "total_latency_ms": ai_result.get("timings_ms", {}).get("total_ms"),
-            "analyzer_latency_ms": ai_result.get("timings_ms", {}).get("analyzer_ms"),
-            "retrieval_latency_ms": ai_result.get("timings_ms", {}).get("retrieval_ms"),
-            "generator_latency_ms": ai_result.get("timings_ms", {}).get("generator_ms"),
-            "guardrails_latency_ms": ai_result.get("timings_ms", {}).get("guardrails_ms"),
-            "fallback_used": ai_result.get("fallback_used", False),
-            "success": True,
-            "error_text": None,
-        },
-    )
+    timings = ai_result.get("timings_ms", {})
+    # Результат ИИ и лог прогона — одной пачкой в одном соединении
+    with write_batch() as cur:
+        set_ai_result(ticket_id, ai_result, cur=cur)
+        log_ai_run(
+            ticket_id=ticket_id,
+            payload={
+                "pipeline_version": ai_result.get("pipeline_version"),
+                "analyzer_model": ai_result.get("analyzer_model"),
+                "generator_model": ai_result.get("generator_model"),
+                "retriever_top_k": len(ai_result.get("sources", [])),
+                "total_latency_ms": timings.get("total_ms"),
+                "analyzer_latency_ms": timings.get("analyzer_ms"),
+                "retrieval_latency_ms": timings.get("retrieval_ms"),
+                "generator_latency_ms": timings.get("generator_ms"),
+                "guardrails_latency_ms": timings.get("guardrails_ms"),
+                "fallback_used": ai_result.get("fallback_used", False),
+                "success": True,
+                "error_text": None,
+            },
+            cur=cur,
+        )
     return ticket_id, ai_result
 
 
+def _json_response(payload) -> Response:
+    """JSON сразу через pydantic-core (Rust), минуя поэлементный jsonable_encoder FastAPI."""
+    return Response(content=to_json(payload), media_type="application/json")
+
+
 # --- Health and email endpoints ---
 @app.get("/health")
 def health():
@@ -352,11 +381,11 @@ def health():
     return checks
 
 
-@app.post("/send", response_model=SendEmailResponse)
+@app.post("/send", responses={200: {"model": SendEmailResponse}})
 def api_send_email(req: SendEmailRequest):
     result = send_email(req.to, req.subject, req.body, req.body_html)
     if result.get("ok"):
-        return SendEmailResponse(ok=True, to=result.get("to"))
+        return _json_response(SendEmailResponse.model_construct(ok=True, to=result.get("to")))
     raise HTTPException(status_code=503, detail=STUB_SEND_MSG)
 
 
@@ -388,7 +417,7 @@ def api_ingest_emails(limit: int = 10, mailbox: str = "INBOX"):
 # --- Tickets API for frontend ---
 @app.get("/tickets")
 def api_list_tickets(limit: int = 100, status: str | None = None):
-    return list_tickets(limit=limit, status=status)
+    return _json_response(list_tickets(limit=limit, status=status))
 
 
 @app.get("/tickets/{ticket_id}")
@@ -396,7 +425,7 @@ def api_get_ticket(ticket_id: int):
     ticket = get_ticket(ticket_id)
     if not ticket:
         raise HTTPException(status_code=404, detail="Ticket not found")
-    return ticket
+    return _json_response(ticket)
 
 
 @app.patch("/tickets/{ticket_id}")
@@ -404,7 +433,7 @@ def api_update_ticket(ticket_id: int, req: UpdateTicketRequest):
     updated = update_ticket(ticket_id, req.model_dump(exclude_none=True))
     if not updated:
         raise HTTPException(status_code=404, detail="Ticket not found")
-    return updated
+    return _json_response(updated)
 
 
 @app.post("/tickets/{ticket_id}/reply")
@@ -417,38 +446,45 @@ def api_reply_ticket(ticket_id: int, req: ReplyTicketRequest):
     subject = req.subject or f"Re: {ticket.get('subject') or 'Ваше обращение'}"
     result = send_email(to_email, subject, req.body)
 
-    create_email_log(
-        ticket_id=ticket_id,
-        raw_from=os.getenv("EMAIL_USER", ""),
-        raw_to=to_email,
-        raw_subject=subject,
-        raw_body=req.body,
-        message_id=None,
-        in_reply_to=None,
-        direction="outgoing",
-        send_status="ok" if result.get("ok") else "error",
-        error_text=result.get("error"),
-    )
+    with write_batch() as cur:
+        create_email_log(
+            ticket_id=ticket_id,
+            raw_from=os.getenv("EMAIL_USER", ""),
+            raw_to=to_email,
+            raw_subject=subject,
+            raw_body=req.body,
+            message_id=None,
+            in_reply_to=None,
+            direction="outgoing",
+            send_status="ok" if result.get("ok") else "error",
+            error_text=result.get("error"),
+            cur=cur,
+        )
+        if result.get("ok"):
+            mark_ticket_sent(ticket_id, req.body, cur=cur)
 
     if not result.get("ok"):
         raise HTTPException(status_code=503, detail=STUB_SEND_MSG)
 
-    mark_ticket_sent(ticket_id, req.body)
     logger.info("Ticket %s replied to %s", ticket_id, to_email)
     return {"ok": True, "ticket_id": ticket_id, "to": to_email, "port": result.get("port")}
 
 
 # --- База знаний (поиск для Qwen и клиентов) ---
-@app.get("/kb/search", response_model=KnowledgeBaseSearchResponse)
+@app.get("/kb/search", responses={200: {"model": KnowledgeBaseSearchResponse}})
 def api_kb_search(q: str = "", limit: int = 5, use_vector: bool = False):
     """
     Поиск по базе знаний. use_vector=true — семантический поиск (нужны заполненные embedding).
     """
-    entries = search_knowledge_base(query=q, limit=limit, use_vector=use_vector)
-    return KnowledgeBaseSearchResponse(
-        query=q,
-        count=len(entries),
-        entries=[KnowledgeBaseEntry(**e) for e in entries],
+    entries = KB_ENTRIES_ADAPTER.validate_python(
+        search_knowledge_base(query=q, limit=limit, use_vector=use_vector)
+    )
+    return _json_response(
+        KnowledgeBaseSearchResponse.model_construct(
+            query=q,
+            count=len(entries),
+            entries=entries,
+        )
     )
 
 
@@ -474,7 +510,7 @@ def _build_kb_context(entries: list[dict]) -> str:
     return "\n\n".join(parts)
 
 
-@app.post("/kb/ask", response_model=KbAskResponse)
+@app.post("/kb/ask", responses={200: {"model": KbAskResponse}})
 def api_kb_ask(req: KbAskRequest):
     """
     Вопрос клиента → поиск в базе знаний → контекст в Qwen → ответ.
@@ -494,11 +530,13 @@ def api_kb_ask(req: KbAskRequest):
             "Не пиши, что «в базе знаний ничего не найдено». Не придумывай факты."
         )
         answer = ask_qwen(system_no_kb, question[:1500])
-        return KbAskResponse(
-            question=question,
-            answer=(answer and answer.strip()) or "Здравствуйте! Получили ваше обращение. Ответим в ближайшее время.",
-            source_ids=[],
-            fallback=True,
+        return _json_response(
+            KbAskResponse.model_construct(
+                question=question,
+                answer=(answer and answer.strip()) or "Здравствуйте! Получили ваше обращение. Ответим в ближайшее время.",
+                source_ids=[],
+                fallback=True,
+            )
         )
 
     system_prompt = (
@@ -509,11 +547,13 @@ def api_kb_ask(req: KbAskRequest):
     answer = ask_qwen(system_prompt, question)
 
     if answer:
-        return KbAskResponse(
-            question=question,
-            answer=answer,
-            source_ids=source_ids,
-            fallback=False,
+        return _json_response(
+            KbAskResponse.model_construct(
+                question=question,
+                answer=answer,
+                source_ids=source_ids,
+                fallback=False,
+            )
         )
 
     # Fallback: первый short_answer или начало content
@@ -524,11 +564,13 @@ def api_kb_ask(req: KbAskRequest):
     if not fallback_text:
         fallback_text = "Ответ по вашему запросу временно недоступен. Обратитесь к оператору."
     logger.info("Qwen unavailable or empty response, using fallback for question=%s", question[:50])
-    return KbAskResponse(
-        question=question,
-        answer=fallback_text,
-        source_ids=source_ids,
-        fallback=True,
+    return _json_response(
+        KbAskResponse.model_construct(
+            question=question,
+            answer=fallback_text,
+            source_ids=source_ids,
+            fallback=True,
+        )
     )
 
 
@@ -548,7 +590,7 @@ def api_save_ticket_to_kb(ticket_id: int, req: SaveToKbRequest):
         content=content,
         short_answer=req.short_answer or ticket.get("answer") or ticket.get("ai_response"),
         category=req.category or ticket.get("category"),
-        tags=req.tags or [],
+        tags=list(req.tags or ()),
         keywords=keywords,
         embedding=embedding,
     )
@@ -599,7 +641,7 @@ STUB_MAIL_MSG = "Подключение к почте не настроено. 
 STUB_SEND_MSG = "Отправка почты будет доступна после настройки. В разработке."
 
 
-@app.post("/mvp/process-latest", response_model=ProcessLatestEmailResponse)
+@app.post("/mvp/process-latest", responses={200: {"model": ProcessLatestEmailResponse}})
 def api_mvp_process_latest(req: ProcessLatestEmailRequest):
     operator_email = req.operator_email or os.getenv("OPERATOR_EMAIL")
     if not operator_email:
@@ -615,15 +657,17 @@ def api_mvp_process_latest(req: ProcessLatestEmailRequest):
         raise HTTPException(status_code=503, detail=STUB_MAIL_MSG)
 
     latest_email = emails[0]
-    msg_id = latest_email.get("message_id") or ""
-    if incoming_email_already_processed(msg_id):
-        logger.info("MVP skip: письмо уже обработано (message_id=%s)", msg_id[:50] if msg_id else "")
+    # UPSERT по message_id сам говорит, новое ли письмо — отдельная проверка до вставки не нужна
+    ticket_id, created = create_or_update_ticket_from_email(latest_email)
+    if not created:
+        msg_id = latest_email.get("message_id") or ""
+        logger.info("MVP skip: письмо уже обработано (message_id=%s)", msg_id[:50])
         raise HTTPException(
             status_code=409,
             detail="Это письмо уже было обработано. Ответ не отправляется повторно.",
         )
+    _log_incoming_email(ticket_id, latest_email, created)
 
-    ticket_id = _ingest_single_email(latest_email)
     ai_result = _run_ai_stub(latest_email)
     set_ai_result(ticket_id, ai_result)
 
@@ -673,27 +717,93 @@ def api_mvp_process_latest(req: ProcessLatestEmailRequest):
         raise HTTPException(status_code=503, detail=STUB_SEND_MSG)
 
     logger.info("MVP processed ticket_id=%s and sent to operator=%s", ticket_id, operator_email)
-    return ProcessLatestEmailResponse(
-        ok=True,
-        source_from=ai_result["from_addr"],
-        source_subject=ai_result["subject"],
-        operator_email=operator_email,
-        ai_decision=f"{ai_result['category']} / {ai_result['priority']}",
-        ai_draft_response=ai_result["draft_answer"],
-        ai_confidence=ai_result.get("confidence"),
-        ai_category=ai_result.get("category"),
-        ai_priority=ai_result.get("priority"),
-        needs_attention=bool(ai_result.get("needs_attention")),
-        auto_send_allowed=bool(ai_result.get("auto_send_allowed")),
-        auto_send_reason=ai_result.get("auto_send_reason"),
-        ai_sources=ai_result.get("sources", []),
-        pipeline_version=ai_result.get("pipeline_version"),
-        timings_ms=ai_result.get("timings_ms", {}),
-        sent_via_port=None,
+    return _json_response(
+        ProcessLatestEmailResponse.model_construct(
+            ok=True,
+            source_from=ai_result["from_addr"],
+            source_subject=ai_result["subject"],
+            operator_email=operator_email,
+            ai_decision=f"{ai_result['category']} / {ai_result['priority']}",
+            ai_draft_response=ai_result["draft_answer"],
+            ai_confidence=ai_result.get("confidence"),
+            ai_category=ai_result.get("category"),
+            ai_priority=ai_result.get("priority"),
+            needs_attention=bool(ai_result.get("needs_attention")),
+            auto_send_allowed=bool(ai_result.get("auto_send_allowed")),
+            auto_send_reason=ai_result.get("auto_send_reason"),
+            ai_sources=ai_result.get("sources", []),
+            pipeline_version=ai_result.get("pipeline_version"),
+            timings_ms=ai_result.get("timings_ms", {}),
+            sent_via_port=None,
+        )
     )
 
 
-@app.post("/mvp/process-demo", response_model=ProcessLatestEmailResponse)
+# Письма батча обрабатываются параллельно: время уходит на HF/Qwen и БД, а не на CPU
+BATCH_CONCURRENCY = 8
+
+
+@app.post("/mvp/process-batch", responses={200: {"model": ProcessBatchEmailsResponse}})
+async def api_mvp_process_batch(req: ProcessBatchEmailsRequest):
+    operator_email = req.operator_email or os.getenv("OPERATOR_EMAIL")
+    if req.notify_operator and not operator_email:
+        raise HTTPException(
+            status_code=400,
+            detail="Укажите email оператора в поле на странице или настройте OPERATOR_EMAIL.",
+        )
+
+    emails = await asyncio.to_thread(fetch_recent_emails, limit=req.limit, mailbox=req.mailbox)
+    if len(emails) == 1 and "error" in emails[0]:
+        raise HTTPException(status_code=503, detail=STUB_MAIL_MSG)
+
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def process_one(email_item: dict) -> tuple[str, tuple[int, dict] | None]:
+        async with semaphore:
+            try:
+                result = await asyncio.to_thread(_process_email_to_ticket, email_item)
+            except Exception as e:
+                logger.exception("Batch: ошибка обработки письма %s: %s", email_item.get("message_id"), e)
+                return "failed", None
+        return ("skipped", None) if result is None else ("processed", result)
+
+    results = await asyncio.gather(*(process_one(e) for e in emails))
+    processed = [r for kind, r in results if kind == "processed"]
+    skipped_count = sum(1 for kind, _ in results if kind == "skipped")
+    failed_count = sum(1 for kind, _ in results if kind == "failed")
+    ticket_ids = [ticket_id for ticket_id, _ in processed]
+
+    digest_sent = False
+    if req.notify_operator and processed:
+        lines = [
+            f"Обработано писем: {len(processed)} из {len(emails)} "
+            f"(уже обработаны ранее: {skipped_count}, ошибок: {failed_count})\n"
+        ]
+        for ticket_id, ai_result in processed:
+            line = f"#{ticket_id}: {ai_result['subject']} — {ai_result.get('category') or '-'}"
+            if ai_result.get("needs_attention"):
+                line += " ⚠ требуется оператор"
+            lines.append(line)
+        send_result = await asyncio.to_thread(
+            send_email, operator_email, "[Внутр. оператору] Digest обработки писем", "\n".join(lines)
+        )
+        digest_sent = bool(send_result.get("ok"))
+
+    logger.info("MVP batch processed=%s skipped=%s failed=%s", len(processed), skipped_count, failed_count)
+    return _json_response(
+        ProcessBatchEmailsResponse.model_construct(
+            ok=True,
+            processed_count=len(processed),
+            ticket_ids=ticket_ids,
+            skipped_count=skipped_count,
+            failed_count=failed_count,
+            operator_email=operator_email,
+            digest_sent=digest_sent,
+        )
+    )
+
+
+@app.post("/mvp/process-demo", responses={200: {"model": ProcessLatestEmailResponse}})
 def api_mvp_process_demo(req: ProcessDemoRequest | None = Body(None)):
     if req is None:
         req = ProcessDemoRequest()
@@ -717,14 +827,16 @@ def api_mvp_process_demo(req: ProcessDemoRequest | None = Body(None)):
     ai_result = _run_ai_stub(stub_email)
     set_ai_result(ticket_id, ai_result)
     logger.info("Demo processed ticket_id=%s", ticket_id)
-    return ProcessLatestEmailResponse(
-        ok=True,
-        source_from=ai_result["from_addr"],
-        source_subject=ai_result["subject"],
-        operator_email="—",
-        ai_decision=f"{ai_result['category']} / {ai_result['priority']}",
-        ai_draft_response=ai_result["draft_answer"],
-        sent_via_port=None,
+    return _json_response(
+        ProcessLatestEmailResponse.model_construct(
+            ok=True,
+            source_from=ai_result["from_addr"],
+            source_subject=ai_result["subject"],
+            operator_email="—",
+            ai_decision=f"{ai_result['category']} / {ai_result['priority']}",
+            ai_draft_response=ai_result["draft_answer"],
+            sent_via_port=None,
+        )
     )
 
 
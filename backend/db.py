@@ -1,11 +1,23 @@
 import logging
 import os
+import threading
 from contextlib import contextmanager
 
 import psycopg
+from psycopg_pool import ConnectionPool
+
+from schema_ddl import KB_CREATE_NO_VECTOR, KB_CREATE_WITH_VECTOR, search_vector_statements
+
+try:
+    from pgvector.psycopg import register_vector
+except ImportError:
+    register_vector = None
 
 logger = logging.getLogger("support_api")
 
+_pool: ConnectionPool | None = None
+_pool_lock = threading.Lock()
+
 
 def get_db_config() -> dict:
     return {
@@ -17,43 +29,76 @@ def get_db_config() -> dict:
     }
 
 
+def _configure_connection(conn: psycopg.Connection) -> None:
+    """Настройка нового соединения пула — один раз, а не на каждый запрос."""
+    if register_vector is None:
+        return
+    try:
+        register_vector(conn)
+    except Exception:
+        # Расширение vector ещё не создано — embedding уйдёт текстовым литералом
+        pass
+
+
+def get_pool() -> ConnectionPool:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            cfg = get_db_config()
+            logger.info("DB pool: host=%s port=%s user=%s dbname=%s", cfg["host"], cfg["port"], cfg["user"], cfg["dbname"])
+            _pool = ConnectionPool(
+                min_size=4,
+                max_size=20,
+                max_idle=60,
+                kwargs={
+                    **cfg,
+                    "autocommit": True,
+                    "client_encoding": "UTF8",
+                },
+                configure=_configure_connection,
+                open=True,
+            )
+    return _pool
+
+
+def close_pool() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
 @contextmanager
 def get_connection():
-    cfg = get_db_config()
-    logger.info("DB connect: host=%s port=%s user=%s dbname=%s", cfg["host"], cfg["port"], cfg["user"], cfg["dbname"])
-    conn = psycopg.connect(
-        host=cfg["host"],
-        port=cfg["port"],
-        user=cfg["user"],
-        password=cfg["password"],
-        dbname=cfg["dbname"],
-        autocommit=True,
-        options="-c client_encoding=UTF8",
-    )
+    with get_pool().connection() as conn:
+        yield conn
+
+
+@contextmanager
+def _direct_connection():
+    """Отдельное соединение вне пула — для DDL при старте, до того как пул настроит адаптеры."""
+    conn = psycopg.connect(**get_db_config(), autocommit=True, client_encoding="UTF8")
     try:
         yield conn
     finally:
         conn.close()
 
 
-def init_db() -> None:
+@contextmanager
+def write_batch():
+    """
+    Одно соединение в pipeline-режиме: несколько записей уходят на сервер подряд,
+    а ответ ждём один раз (Sync в конце блока), вместо отдельного round-trip на каждую.
+    """
     with get_connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
-            try:
-                cur.execute("CREATE EXTENSION IF NOT EXISTS vector;")
-                has_pgvector = True
-            except Exception as e:
-                if "vector" in str(e).lower() or "not available" in str(e).lower():
-                    has_pgvector = False
-                    import logging
-                    logging.getLogger("support_api").warning(
-                        "pgvector не установлен — расширение vector пропущено. Поиск по embedding в KB будет недоступен. Ошибка: %s", e
-                    )
-                else:
-                    raise
+        with conn.pipeline():
+            with conn.cursor() as cur:
+                yield cur
+
 
-    statements = [
+def _schema_statements(has_pgvector: bool) -> tuple[str, ...]:
+    return (
         """
         CREATE TABLE IF NOT EXISTS operators (
             id SERIAL PRIMARY KEY,
@@ -96,43 +141,44 @@ def init_db() -> None:
             updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             processed_at TIMESTAMP,
             resolved_at TIMESTAMP,
-            search_vector tsvector GENERATED ALWAYS AS (
-                setweight(to_tsvector('simple', coalesce(question,'')), 'A') ||
-                setweight(to_tsvector('simple', coalesce(answer,'')), 'B')
-            ) STORED
+            search_vector tsvector
         );
         """,
-        "ALTER TABLE tickets ADD COLUMN IF NOT EXISTS ai_processing_time_ms INTEGER;",
-        "ALTER TABLE tickets ADD COLUMN IF NOT EXISTS ai_model VARCHAR(100);",
-        "ALTER TABLE tickets ADD COLUMN IF NOT EXISTS ai_sources JSONB DEFAULT '[]'::jsonb;",
-        "ALTER TABLE tickets ADD COLUMN IF NOT EXISTS ai_reasoning_short TEXT;",
-        "ALTER TABLE tickets ADD COLUMN IF NOT EXISTS pipeline_version VARCHAR(50);",
-        "ALTER TABLE tickets ADD COLUMN IF NOT EXISTS auto_send_allowed BOOLEAN DEFAULT FALSE;",
-        "ALTER TABLE tickets ADD COLUMN IF NOT EXISTS auto_send_reason TEXT;",
+        # Недостающие колонки — одним ALTER TABLE: одна блокировка и одно обновление каталога
         """
         ALTER TABLE tickets
-        ADD COLUMN IF NOT EXISTS search_vector tsvector
-        GENERATED ALWAYS AS (
-            setweight(to_tsvector('simple', coalesce(question,'')), 'A') ||
-            setweight(to_tsvector('simple', coalesce(answer,'')), 'B')
-        ) STORED;
+            ADD COLUMN IF NOT EXISTS ai_processing_time_ms INTEGER,
+            ADD COLUMN IF NOT EXISTS ai_model VARCHAR(100),
+            ADD COLUMN IF NOT EXISTS ai_sources JSONB DEFAULT '[]'::jsonb,
+            ADD COLUMN IF NOT EXISTS ai_reasoning_short TEXT,
+            ADD COLUMN IF NOT EXISTS pipeline_version VARCHAR(50),
+            ADD COLUMN IF NOT EXISTS auto_send_allowed BOOLEAN DEFAULT FALSE,
+            ADD COLUMN IF NOT EXISTS auto_send_reason TEXT,
+            ADD COLUMN IF NOT EXISTS search_vector tsvector,
+            ADD COLUMN IF NOT EXISTS phone VARCHAR(50),
+            ADD COLUMN IF NOT EXISTS location_object VARCHAR(255),
+            ADD COLUMN IF NOT EXISTS serial_numbers VARCHAR(255),
+            ADD COLUMN IF NOT EXISTS device_type VARCHAR(255),
+            ADD COLUMN IF NOT EXISTS ai_category VARCHAR(100),
+            ADD COLUMN IF NOT EXISTS ai_priority VARCHAR(50),
+            ADD COLUMN IF NOT EXISTS ai_tone VARCHAR(50),
+            ADD COLUMN IF NOT EXISTS processed_at TIMESTAMP,
+            ADD COLUMN IF NOT EXISTS resolved_at TIMESTAMP,
+            ADD COLUMN IF NOT EXISTS message_id VARCHAR(255),
+            ADD COLUMN IF NOT EXISTS in_reply_to VARCHAR(255);
         """,
-        "ALTER TABLE tickets ADD COLUMN IF NOT EXISTS phone VARCHAR(50);",
-        "ALTER TABLE tickets ADD COLUMN IF NOT EXISTS location_object VARCHAR(255);",
-        "ALTER TABLE tickets ADD COLUMN IF NOT EXISTS serial_numbers VARCHAR(255);",
-        "ALTER TABLE tickets ADD COLUMN IF NOT EXISTS device_type VARCHAR(255);",
-        "ALTER TABLE tickets ADD COLUMN IF NOT EXISTS ai_category VARCHAR(100);",
-        "ALTER TABLE tickets ADD COLUMN IF NOT EXISTS ai_priority VARCHAR(50);",
-        "ALTER TABLE tickets ADD COLUMN IF NOT EXISTS ai_tone VARCHAR(50);",
-        "ALTER TABLE tickets ADD COLUMN IF NOT EXISTS processed_at TIMESTAMP;",
-        "ALTER TABLE tickets ADD COLUMN IF NOT EXISTS resolved_at TIMESTAMP;",
-        "ALTER TABLE tickets ADD COLUMN IF NOT EXISTS message_id VARCHAR(255);",
-        "ALTER TABLE tickets ADD COLUMN IF NOT EXISTS in_reply_to VARCHAR(255);",
+        *search_vector_statements("tickets", "russian", "question", "answer"),
         "CREATE UNIQUE INDEX IF NOT EXISTS idx_tickets_message_id_unique ON tickets(message_id);",
-        "CREATE INDEX IF NOT EXISTS idx_tickets_status ON tickets(status);",
         "CREATE INDEX IF NOT EXISTS idx_tickets_client_email ON tickets(client_email);",
         "CREATE INDEX IF NOT EXISTS idx_tickets_created_at ON tickets(created_at DESC);",
-        "CREATE INDEX IF NOT EXISTS idx_tickets_needs_attention ON tickets(needs_attention);",
+        "CREATE INDEX IF NOT EXISTS idx_tickets_status_created_at ON tickets(status, created_at DESC);",
+        # Вместо полных индексов по булевым флагам и по status (префикс status_created_at) —
+        # частичные: в них только открытые / требующие внимания тикеты, малая доля таблицы
+        "DROP INDEX IF EXISTS idx_tickets_status;",
+        "DROP INDEX IF EXISTS idx_tickets_is_resolved;",
+        "DROP INDEX IF EXISTS idx_tickets_needs_attention;",
+        "CREATE INDEX IF NOT EXISTS idx_tickets_open ON tickets(created_at DESC) WHERE is_resolved = FALSE;",
+        "CREATE INDEX IF NOT EXISTS idx_tickets_attn ON tickets(created_at DESC) WHERE needs_attention = TRUE;",
         "CREATE INDEX IF NOT EXISTS idx_tickets_search ON tickets USING GIN (search_vector);",
         """
         CREATE TABLE IF NOT EXISTS email_log (
@@ -150,47 +196,29 @@ def init_db() -> None:
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         );
         """,
-        "ALTER TABLE email_log ADD COLUMN IF NOT EXISTS send_status VARCHAR(50);",
-        "ALTER TABLE email_log ADD COLUMN IF NOT EXISTS error_text TEXT;",
-        "CREATE INDEX IF NOT EXISTS idx_email_log_ticket ON email_log(ticket_id);",
-        "CREATE INDEX IF NOT EXISTS idx_email_log_message_id ON email_log(message_id);",
         """
-        CREATE TABLE IF NOT EXISTS knowledge_base (
-            id SERIAL PRIMARY KEY,
-            ticket_id INTEGER REFERENCES tickets(id) ON DELETE SET NULL,
-            title VARCHAR(500) NOT NULL,
-            content TEXT NOT NULL,
-            short_answer TEXT,
-            tags TEXT[],
-            category VARCHAR(100),
-            usage_count INTEGER DEFAULT 0,
-            success_rate FLOAT DEFAULT 1.0,
-            keywords TEXT[],
-            embedding vector(384),
-            is_active BOOLEAN DEFAULT TRUE,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            search_vector tsvector GENERATED ALWAYS AS (
-                setweight(to_tsvector('simple', coalesce(title,'')), 'A') ||
-                setweight(to_tsvector('simple', coalesce(content,'')), 'B')
-            ) STORED
-        );
+        ALTER TABLE email_log
+            ADD COLUMN IF NOT EXISTS send_status VARCHAR(50),
+            ADD COLUMN IF NOT EXISTS error_text TEXT;
         """,
-        "ALTER TABLE knowledge_base ADD COLUMN IF NOT EXISTS success_rate FLOAT DEFAULT 1.0;",
-        "ALTER TABLE knowledge_base ADD COLUMN IF NOT EXISTS keywords TEXT[];",
-        "ALTER TABLE knowledge_base ADD COLUMN IF NOT EXISTS embedding vector(384);",
-        "ALTER TABLE knowledge_base ADD COLUMN IF NOT EXISTS ticket_id INTEGER REFERENCES tickets(id) ON DELETE SET NULL;",
+        "CREATE INDEX IF NOT EXISTS idx_email_log_ticket ON email_log(ticket_id);",
+        "CREATE INDEX IF NOT EXISTS idx_email_log_message_id ON email_log(message_id);",
+        KB_CREATE_WITH_VECTOR if has_pgvector else KB_CREATE_NO_VECTOR,
         """
         ALTER TABLE knowledge_base
-        ADD COLUMN IF NOT EXISTS search_vector tsvector
-        GENERATED ALWAYS AS (
-            setweight(to_tsvector('simple', coalesce(title,'')), 'A') ||
-            setweight(to_tsvector('simple', coalesce(content,'')), 'B')
-        ) STORED;
+            ADD COLUMN IF NOT EXISTS success_rate FLOAT DEFAULT 1.0,
+            ADD COLUMN IF NOT EXISTS keywords TEXT[],
+            ADD COLUMN IF NOT EXISTS ticket_id INTEGER REFERENCES tickets(id) ON DELETE SET NULL,
+            ADD COLUMN IF NOT EXISTS search_vector tsvector;
         """,
+        *(("ALTER TABLE knowledge_base ADD COLUMN IF NOT EXISTS embedding vector(384);",) if has_pgvector else ()),
+        *search_vector_statements("knowledge_base", "russian", "title", "content"),
         "CREATE INDEX IF NOT EXISTS idx_kb_category ON knowledge_base(category);",
         "CREATE INDEX IF NOT EXISTS idx_kb_active ON knowledge_base(is_active);",
         "CREATE INDEX IF NOT EXISTS idx_kb_search ON knowledge_base USING GIN (search_vector);",
+        # Триграммы: ILIKE '%слово%' в фолбэках поиска идёт по индексу, а не seq scan
+        "CREATE INDEX IF NOT EXISTS idx_kb_title_trgm ON knowledge_base USING GIN (title gin_trgm_ops);",
+        "CREATE INDEX IF NOT EXISTS idx_kb_content_trgm ON knowledge_base USING GIN (content gin_trgm_ops);",
         """
         CREATE TABLE IF NOT EXISTS ai_run_log (
             id SERIAL PRIMARY KEY,
@@ -212,38 +240,33 @@ def init_db() -> None:
         """,
         "CREATE INDEX IF NOT EXISTS idx_ai_run_log_ticket_id ON ai_run_log(ticket_id);",
         "CREATE INDEX IF NOT EXISTS idx_ai_run_log_created_at ON ai_run_log(created_at DESC);",
-    ]
+    )
 
-    # Таблица knowledge_base без колонки embedding (если pgvector недоступен)
-    kb_create_no_vector = """
-        CREATE TABLE IF NOT EXISTS knowledge_base (
-            id SERIAL PRIMARY KEY,
-            ticket_id INTEGER REFERENCES tickets(id) ON DELETE SET NULL,
-            title VARCHAR(500) NOT NULL,
-            content TEXT NOT NULL,
-            short_answer TEXT,
-            tags TEXT[],
-            category VARCHAR(100),
-            usage_count INTEGER DEFAULT 0,
-            success_rate FLOAT DEFAULT 1.0,
-            keywords TEXT[],
-            is_active BOOLEAN DEFAULT TRUE,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            search_vector tsvector GENERATED ALWAYS AS (
-                setweight(to_tsvector('simple', coalesce(title,'')), 'A') ||
-                setweight(to_tsvector('simple', coalesce(content,'')), 'B')
-            ) STORED
-        );
-        """
 
-    with get_connection() as conn:
+# Оба варианта схемы собираются один раз при импорте
+_SCHEMA_WITH_VECTOR = _schema_statements(True)
+_SCHEMA_WITHOUT_VECTOR = _schema_statements(False)
+
+
+def init_db() -> None:
+    with _direct_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+            try:
+                cur.execute("CREATE EXTENSION IF NOT EXISTS vector;")
+                has_pgvector = True
+            except Exception as e:
+                if "vector" in str(e).lower() or "not available" in str(e).lower():
+                    has_pgvector = False
+                    import logging
+                    logging.getLogger("support_api").warning(
+                        "pgvector не установлен — расширение vector пропущено. Поиск по embedding в KB будет недоступен. Ошибка: %s", e
+                    )
+                else:
+                    raise
+
+    with _direct_connection() as conn:
         with conn.cursor() as cur:
-            for stmt in statements:
-                if not has_pgvector and ("vector(384)" in stmt or "embedding vector" in stmt):
-                    continue
-                if not has_pgvector and "CREATE TABLE IF NOT EXISTS knowledge_base" in stmt and "embedding" in stmt:
-                    cur.execute(kb_create_no_vector)
-                    continue
+            for stmt in _SCHEMA_WITH_VECTOR if has_pgvector else _SCHEMA_WITHOUT_VECTOR:
                 cur.execute(stmt)
 
@@ -8,6 +8,7 @@ import logging
 import os
 import urllib.request
 from pathlib import Path
+from typing import Any
 
 try:
     from dotenv import load_dotenv
@@ -33,21 +34,10 @@ def _get_config() -> dict:
     }
 
 
-def get_embedding(text: str) -> list[float] | None:
-    """
-    Возвращает вектор эмбеддинга для текста (384 измерений для MiniLM).
-    При ошибке или отсутствии HF_TOKEN возвращает None.
-    """
-    text = (text or "").strip()
-    if not text:
-        return None
+def _post_inputs(inputs: str | list[str]) -> Any:
     cfg = _get_config()
-    if not cfg["token"]:
-        logger.warning("HF_TOKEN not set, cannot get embedding")
-        return None
-
     url = f"{HF_INFERENCE_URL}/{cfg['model']}"
-    body = json.dumps({"inputs": text[:8192]}).encode("utf-8")
+    body = json.dumps({"inputs": inputs}).encode("utf-8")
     req = urllib.request.Request(
         url,
         data=body,
@@ -57,9 +47,30 @@ def get_embedding(text: str) -> list[float] | None:
         },
         method="POST",
     )
+    with urllib.request.urlopen(req, timeout=30) as resp:
+        return json.loads(resp.read().decode("utf-8"))
+
+
+def _as_vector(item: Any) -> list[float] | None:
+    if isinstance(item, list) and item and isinstance(item[0], (int, float)):
+        return list(item)
+    return None
+
+
+def get_embedding(text: str) -> list[float] | None:
+    """
+    Возвращает вектор эмбеддинга для текста (384 измерений для MiniLM).
+    При ошибке или отсутствии HF_TOKEN возвращает None.
+    """
+    text = (text or "").strip()
+    if not text:
+        return None
+    if not _get_config()["token"]:
+        logger.warning("HF_TOKEN not set, cannot get embedding")
+        return None
+
     try:
-        with urllib.request.urlopen(req, timeout=30) as resp:
-            out = json.loads(resp.read().decode("utf-8"))
+        out = _post_inputs(text[:8192])
         if isinstance(out, list):
             if len(out) > 0 and isinstance(out[0], (list, tuple)):
                 return list(out[0])
@@ -69,3 +80,27 @@ def get_embedding(text: str) -> list[float] | None:
     except Exception as e:
         logger.exception("Embedding API failed: %s", e)
         return None
+
+
+def get_embeddings(texts: list[str]) -> list[list[float] | None]:
+    """
+    Эмбеддинги для пачки текстов одним запросом к HF API (inputs — список строк).
+    Возвращает список той же длины; None — для пустого текста или при ошибке.
+    """
+    result: list[list[float] | None] = [None] * len(texts)
+    batch = [(i, t.strip()[:8192]) for i, t in enumerate(texts) if t and t.strip()]
+    if not batch:
+        return result
+    if not _get_config()["token"]:
+        logger.warning("HF_TOKEN not set, cannot get embedding")
+        return result
+
+    try:
+        out = _post_inputs([t for _, t in batch])
+    except Exception as e:
+        logger.exception("Embedding API failed: %s", e)
+        return result
+    if isinstance(out, list) and len(out) == len(batch):
+        for (i, _), item in zip(batch, out):
+            result[i] = _as_vector(item)
+    return result
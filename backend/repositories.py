@@ -1,71 +1,115 @@
 import re
-from datetime import datetime
+import threading
+import time
+from collections import OrderedDict
 from email.utils import parseaddr
 from typing import Any
 
+from psycopg import Connection, Cursor
 from psycopg.rows import dict_row
 
 from db import get_connection
 
 try:
-    from embedding_service import get_embedding
+    from embedding_service import get_embedding, get_embeddings
 except ImportError:
     get_embedding = None
+    get_embeddings = None
 
+# Сколько текстов отправлять в HF API за один запрос при заполнении embedding
+_EMBEDDING_BATCH_SIZE = 32
 
-def _ticket_to_front(ticket: dict[str, Any]) -> dict[str, Any]:
-    return {
-        "id": ticket["id"],
-        "date": ticket["created_at"],
-        "full_name": ticket.get("client_name") or "Неизвестный клиент",
-        "object": ticket.get("location_object") or "-",
-        "phone": ticket.get("phone") or "-",
-        "email": ticket["client_email"],
-        "serial_numbers": ticket.get("serial_numbers") or "-",
-        "device_type": ticket.get("device_type") or "-",
-        "emotional_tone": ticket.get("ai_tone") or "Нейтральный",
-        "question": ticket.get("question") or "-",
-        "ai_response": ticket.get("ai_suggested_answer") or ticket.get("answer") or "-",
-        "subject": ticket.get("subject") or "",
-        "status": ticket.get("status") or "new",
-        "needs_attention": bool(ticket.get("needs_attention")),
-        "is_resolved": bool(ticket.get("is_resolved")),
-        "category": ticket.get("ai_category"),
-        "priority": ticket.get("ai_priority"),
-        "ai_confidence": ticket.get("ai_confidence"),
-        "ai_sources": ticket.get("ai_sources") or [],
-        "pipeline_version": ticket.get("pipeline_version"),
-        "auto_send_allowed": bool(ticket.get("auto_send_allowed")),
-        "auto_send_reason": ticket.get("auto_send_reason"),
-    }
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 
-def list_tickets(limit: int = 100, status: str | None = None) -> list[dict[str, Any]]:
-    query = """
-        SELECT *
-        FROM tickets
-        WHERE (%s::text IS NULL OR status = %s)
-        ORDER BY created_at DESC
-        LIMIT %s
+def _execute_write(cur: Cursor | None, query: str, params: tuple) -> None:
+    """
+    Выполняет запись в переданном курсоре (пачка через write_batch) или в отдельном соединении.
+    SQL у всех вызывающих статический, поэтому он подготавливается (prepare=True): на соединении
+    из пула Parse делается один раз, дальше уходят только Bind/Execute.
     """
+    if cur is not None:
+        cur.execute(query, params, prepare=True)
+        return
+    with get_connection() as conn:
+        with conn.cursor() as own_cur:
+            own_cur.execute(query, params, prepare=True)
+
+
+# Проекция строки tickets в формат фронта считается в PostgreSQL: Python только отдаёт dict_row.
+# NULLIF(..., '') повторяет прежнюю семантику `value or default` для пустых строк.
+_TICKET_FRONT_COLUMNS = """
+    id,
+    created_at AS date,
+    COALESCE(NULLIF(client_name, ''), 'Неизвестный клиент') AS full_name,
+    COALESCE(NULLIF(location_object, ''), '-') AS object,
+    COALESCE(NULLIF(phone, ''), '-') AS phone,
+    client_email AS email,
+    COALESCE(NULLIF(serial_numbers, ''), '-') AS serial_numbers,
+    COALESCE(NULLIF(device_type, ''), '-') AS device_type,
+    COALESCE(NULLIF(ai_tone, ''), 'Нейтральный') AS emotional_tone,
+    COALESCE(NULLIF(question, ''), '-') AS question,
+    COALESCE(NULLIF(ai_suggested_answer, ''), NULLIF(answer, ''), '-') AS ai_response,
+    COALESCE(subject, '') AS subject,
+    COALESCE(NULLIF(status, ''), 'new') AS status,
+    COALESCE(needs_attention, FALSE) AS needs_attention,
+    COALESCE(is_resolved, FALSE) AS is_resolved,
+    ai_category AS category,
+    ai_priority AS priority,
+    ai_confidence,
+    COALESCE(ai_sources, '[]'::jsonb) AS ai_sources,
+    pipeline_version,
+    COALESCE(auto_send_allowed, FALSE) AS auto_send_allowed,
+    auto_send_reason
+"""
+
+# Карточка тикета: то же плюс полный ответ и черновик ИИ
+_TICKET_DETAIL_COLUMNS = _TICKET_FRONT_COLUMNS + """,
+    COALESCE(answer, '') AS answer,
+    COALESCE(ai_suggested_answer, '') AS ai_draft
+"""
+
+# Два отдельных запроса вместо `(%s IS NULL OR status = %s)`: без OR планировщик берёт
+# idx_tickets_created_at / idx_tickets_status_created_at и останавливается после LIMIT строк.
+_LIST_TICKETS_SQL = f"""
+    SELECT {_TICKET_FRONT_COLUMNS}
+    FROM tickets
+    ORDER BY created_at DESC
+    LIMIT %s
+"""
+
+_LIST_TICKETS_BY_STATUS_SQL = f"""
+    SELECT {_TICKET_FRONT_COLUMNS}
+    FROM tickets
+    WHERE status = %s
+    ORDER BY created_at DESC
+    LIMIT %s
+"""
+
+_GET_TICKET_SQL = f"SELECT {_TICKET_DETAIL_COLUMNS} FROM tickets WHERE id = %s"
+
+
+def _list_tickets_query(limit: int, status: str | None) -> tuple[str, tuple]:
+    if status is None:
+        return _LIST_TICKETS_SQL, (limit,)
+    return _LIST_TICKETS_BY_STATUS_SQL, (status, limit)
+
+
+def list_tickets(limit: int = 100, status: str | None = None) -> list[dict[str, Any]]:
     with get_connection() as conn:
         with conn.cursor(row_factory=dict_row) as cur:
-            cur.execute(query, (status, status, limit))
-            rows = cur.fetchall()
-    return [_ticket_to_front(row) for row in rows]
+            cur.execute(*_list_tickets_query(limit, status), prepare=True)
+            return cur.fetchall()
 
 
 def get_ticket(ticket_id: int) -> dict[str, Any] | None:
     with get_connection() as conn:
         with conn.cursor(row_factory=dict_row) as cur:
-            cur.execute("SELECT * FROM tickets WHERE id = %s", (ticket_id,))
-            row = cur.fetchone()
-    if not row:
-        return None
-    payload = _ticket_to_front(row)
-    payload["answer"] = row.get("answer") or ""
-    payload["ai_draft"] = row.get("ai_suggested_answer") or ""
-    return payload
+            cur.execute(_GET_TICKET_SQL, (ticket_id,), prepare=True)
+            return cur.fetchone()
 
 
 def update_ticket(ticket_id: int, updates: dict[str, Any]) -> dict[str, Any] | None:
@@ -90,15 +134,16 @@ def update_ticket(ticket_id: int, updates: dict[str, Any]) -> dict[str, Any] | N
 
     assignments = ", ".join(f"{k} = %s" for k in safe_updates.keys())
     params = list(safe_updates.values())
-    params.extend([datetime.utcnow(), ticket_id])
+    params.append(ticket_id)
 
     with get_connection() as conn:
-        with conn.cursor() as cur:
+        with conn.cursor(row_factory=dict_row) as cur:
             cur.execute(
-                f"UPDATE tickets SET {assignments}, updated_at = %s WHERE id = %s",
+                f"UPDATE tickets SET {assignments}, updated_at = CURRENT_TIMESTAMP WHERE id = %s "
+                f"RETURNING {_TICKET_DETAIL_COLUMNS}",
                 params,
             )
-    return get_ticket(ticket_id)
+            return cur.fetchone()
 
 
 def create_or_update_ticket_from_email(email_item: dict[str, Any]) -> tuple[int, bool]:
@@ -109,87 +154,126 @@ def create_or_update_ticket_from_email(email_item: dict[str, Any]) -> tuple[int,
     in_reply_to = (email_item.get("in_reply_to") or "").strip() or None
     body = email_item.get("body") or email_item.get("body_preview") or ""
 
-    with get_connection() as conn:
-        with conn.cursor(row_factory=dict_row) as cur:
-            if message_id:
-                cur.execute("SELECT id FROM tickets WHERE message_id = %s", (message_id,))
-                existing = cur.fetchone()
-                if existing:
-                    return int(existing["id"]), False
-
-            cur.execute(
-                """
-                INSERT INTO tickets (
-                    client_email, client_name, subject, question, status, message_id, in_reply_to
-                ) VALUES (%s, %s, %s, %s, 'new', %s, %s)
-                RETURNING id
-                """,
-                (from_email, from_name or None, subject, body, message_id, in_reply_to),
-            )
-            ticket = cur.fetchone()
-    return int(ticket["id"]), True
-
-
-def set_ai_result(ticket_id: int, ai_result: dict[str, Any]) -> None:
-    with get_connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                UPDATE tickets
-                SET ai_suggested_answer = %s,
-                    ai_category = %s,
-                    ai_priority = %s,
-                    ai_tone = %s,
-                    ai_confidence = %s,
-                    ai_model = %s,
-                    ai_sources = %s,
-                    ai_reasoning_short = %s,
-                    pipeline_version = %s,
-                    ai_processing_time_ms = %s,
-                    auto_send_allowed = %s,
-                    auto_send_reason = %s,
-                    needs_attention = %s,
-                    status = 'drafted',
-                    processed_at = %s,
-                    updated_at = %s
-                WHERE id = %s
-                """,
-                (
-                    ai_result.get("draft_answer"),
-                    ai_result.get("category"),
-                    ai_result.get("priority"),
-                    ai_result.get("tone"),
-                    ai_result.get("confidence"),
-                    ai_result.get("model"),
-                    ai_result.get("sources", []),
-                    ai_result.get("reasoning_short"),
-                    ai_result.get("pipeline_version"),
-                    ai_result.get("processing_time_ms"),
-                    ai_result.get("auto_send_allowed", False),
-                    ai_result.get("auto_send_reason"),
-                    ai_result.get("needs_attention", False),
-                    datetime.utcnow(),
-                    datetime.utcnow(),
-                    ticket_id,
-                ),
-            )
-
-
-def mark_ticket_sent(ticket_id: int, final_answer: str) -> None:
+    # Один запрос: INSERT ... ON CONFLICT (message_id) DO NOTHING, а для повтора (агент опрашивает
+    # ящик и получает те же письма) — id существующего тикета из той же таблицы. Повтор ничего
+    # не пишет в tickets — ни новой версии строки, ни WAL.
+    # Пустой результат возможен, только если конфликтующий тикет удалили или вставили в параллельной
+    # транзакции после снимка запроса, — тогда повторяем один раз уже с новым снимком.
     with get_connection() as conn:
         with conn.cursor() as cur:
-            cur.execute(
-                """
-                UPDATE tickets
-                SET answer = %s,
-                    status = 'sent',
-                    is_resolved = TRUE,
-                    resolved_at = %s,
-                    updated_at = %s
-                WHERE id = %s
-                """,
-                (final_answer, datetime.utcnow(), datetime.utcnow(), ticket_id),
-            )
+            for _ in range(2):
+                cur.execute(
+                    """
+                    WITH ins AS (
+                        INSERT INTO tickets (
+                            client_email, client_name, subject, question, status, message_id, in_reply_to
+                        ) VALUES (%s, %s, %s, %s, 'new', %s, %s)
+                        ON CONFLICT (message_id) DO NOTHING
+                        RETURNING id
+                    )
+                    SELECT id, TRUE FROM ins
+                    UNION ALL
+                    SELECT id, FALSE FROM tickets WHERE message_id = %s AND NOT EXISTS (SELECT 1 FROM ins)
+                    LIMIT 1
+                    """,
+                    (from_email, from_name or None, subject, body, message_id, in_reply_to, message_id),
+                    prepare=True,
+                )
+                row = cur.fetchone()
+                if row is not None:
+                    return int(row[0]), bool(row[1])
+    raise RuntimeError(f"Не удалось создать или найти тикет для message_id={message_id!r}")
+
+
+def set_ai_result(ticket_id: int, ai_result: dict[str, Any], cur: Cursor | None = None) -> None:
+    _execute_write(
+        cur,
+        """
+        UPDATE tickets
+        SET ai_suggested_answer = %s,
+            ai_category = %s,
+            ai_priority = %s,
+            ai_tone = %s,
+            ai_confidence = %s,
+            ai_model = %s,
+            ai_sources = %s,
+            ai_reasoning_short = %s,
+            pipeline_version = %s,
+            ai_processing_time_ms = %s,
+            auto_send_allowed = %s,
+            auto_send_reason = %s,
+            needs_attention = %s,
+            status = 'drafted',
+            processed_at = CURRENT_TIMESTAMP,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE id = %s
+        """,
+        (
+            ai_result.get("draft_answer"),
+            ai_result.get("category"),
+            ai_result.get("priority"),
+            ai_result.get("tone"),
+            ai_result.get("confidence"),
+            ai_result.get("model"),
+            ai_result.get("sources", []),
+            ai_result.get("reasoning_short"),
+            ai_result.get("pipeline_version"),
+            ai_result.get("processing_time_ms"),
+            ai_result.get("auto_send_allowed", False),
+            ai_result.get("auto_send_reason"),
+            ai_result.get("needs_attention", False),
+            ticket_id,
+        ),
+    )
+
+
+def mark_ticket_sent(ticket_id: int, final_answer: str, cur: Cursor | None = None) -> None:
+    _execute_write(
+        cur,
+        """
+        UPDATE tickets
+        SET answer = %s,
+            status = 'sent',
+            is_resolved = TRUE,
+            resolved_at = CURRENT_TIMESTAMP,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE id = %s
+        """,
+        (final_answer, ticket_id),
+    )
+
+
+_WORD_RE = re.compile(r"\W+")
+# Символы, ломающие tsquery: слова с ними в OR-запрос не берём
+_TSQUERY_FORBIDDEN = str.maketrans("", "", "'&!()")
+_LIKE_ESCAPE = str.maketrans({"%": "\\%", "_": "\\_"})
+
+
+def _like_pattern(text: str) -> str:
+    return f"%{text.translate(_LIKE_ESCAPE)}%"
+
+
+_MAX_QUERY_WORDS = 10
+
+
+def _query_words(query: str) -> list[str]:
+    words = [
+        w
+        for w in _WORD_RE.split(query)
+        if len(w) >= 2 and w.translate(_TSQUERY_FORBIDDEN) == w
+    ]
+    return words[:_MAX_QUERY_WORDS]
+
+
+def _vector_param(conn: Connection, emb: list[float]) -> Any:
+    """
+    Параметр для колонки vector. Если пул зарегистрировал на соединении адаптеры pgvector,
+    вектор уходит массивом float32 в бинарном формате (без форматирования 384 чисел
+    в строку и парсинга на сервере); иначе — текстовый литерал '[x,y,...]'.
+    """
+    if np is not None and conn.adapters.types.get("vector") is not None:
+        return np.asarray(emb, dtype=np.float32)
+    return "[" + ",".join(map(str, emb)) + "]"
 
 
 def _kb_row_to_dict(r: dict) -> dict[str, Any]:
@@ -199,10 +283,125 @@ def _kb_row_to_dict(r: dict) -> dict[str, Any]:
         "content": r["content"],
         "short_answer": r.get("short_answer"),
         "category": r.get("category"),
-        "rank": float(r["rank"]) if r.get("rank") is not None else None,
+        "rank": r.get("rank"),
     }
 
 
+def _kb_text_search_sql(word_count: int, with_fts: bool = True) -> str:
+    """
+    Все ступени текстового поиска одним запросом (один round-trip вместо до четырёх):
+    точный полнотекст → OR по словам → ILIKE по фразе → ILIKE по первому слову с совпадениями.
+    Каждая следующая ступень выполняется, только если предыдущие ничего не нашли (NOT EXISTS),
+    поэтому в результате строки ровно одной ступени. Порядок задаёт внешний ORDER BY по номеру
+    ступени и rank: порядок строк UNION ALL без него PostgreSQL не гарантирует.
+    """
+    tiers: list[tuple[str, str]] = []
+    if with_fts:
+        tiers.append((
+            "exact",
+            """
+            SELECT id, title, content, short_answer, category,
+                   ts_rank(search_vector, plainto_tsquery('russian', %(query)s))::float8 AS rank
+            FROM knowledge_base
+            WHERE is_active = TRUE
+              AND search_vector @@ plainto_tsquery('russian', %(query)s)
+            ORDER BY rank DESC
+            LIMIT %(limit)s
+            """,
+        ))
+        if word_count:
+            # OR по каждому слову через plainto_tsquery (надёжнее, чем to_tsquery с "a | b")
+            or_ts = " || ".join(
+                f"plainto_tsquery('russian', (%(words)s::text[])[{i}])" for i in range(1, word_count + 1)
+            )
+            tiers.append((
+                "any_word",
+                f"""
+                SELECT id, title, content, short_answer, category, 1.0::float8 AS rank
+                FROM knowledge_base
+                WHERE {{guard}}is_active = TRUE
+                  AND search_vector @@ ({or_ts})
+                ORDER BY id
+                LIMIT %(limit)s
+                """,
+            ))
+    tiers.append((
+        "phrase",
+        """
+        SELECT id, title, content, short_answer, category, 1.0::float8 AS rank
+        FROM knowledge_base
+        WHERE {guard}is_active = TRUE
+          AND (title ILIKE %(pattern)s OR content ILIKE %(pattern)s)
+        LIMIT %(limit)s
+        """,
+    ))
+    if word_count:
+        tiers.append((
+            "first_word",
+            """
+            SELECT w.pattern
+            FROM unnest(%(word_patterns)s::text[]) WITH ORDINALITY AS w(pattern, pos)
+            WHERE {guard}EXISTS (
+                SELECT 1 FROM knowledge_base
+                WHERE is_active = TRUE AND (title ILIKE w.pattern OR content ILIKE w.pattern)
+            )
+            ORDER BY w.pos
+            LIMIT 1
+            """,
+        ))
+        tiers.append((
+            "single_word",
+            """
+            SELECT kb.id, kb.title, kb.content, kb.short_answer, kb.category, 1.0::float8 AS rank
+            FROM knowledge_base kb, first_word f
+            WHERE kb.is_active = TRUE
+              AND (kb.title ILIKE f.pattern OR kb.content ILIKE f.pattern)
+            LIMIT %(limit)s
+            """,
+        ))
+
+    ctes = []
+    result_tiers = []
+    previous: list[str] = []
+    for name, body in tiers:
+        guard = "".join(f"NOT EXISTS (SELECT 1 FROM {p}) AND " for p in previous)
+        ctes.append(f"{name} AS ({body.replace('{guard}', guard)})")
+        if name == "first_word":
+            continue
+        result_tiers.append(f"SELECT {len(result_tiers)} AS tier, * FROM {name}")
+        previous.append(name)
+    return (
+        "WITH " + ",\n".join(ctes) + "\n"
+        + "\nUNION ALL\n".join(result_tiers)
+        + "\nORDER BY tier, rank DESC, id\nLIMIT %(limit)s"
+    )
+
+
+# SQL зависит только от числа слов (0.._MAX_QUERY_WORDS) — собираем все варианты один раз при импорте
+_KB_TEXT_SEARCH_SQLS = tuple(_kb_text_search_sql(n) for n in range(_MAX_QUERY_WORDS + 1))
+_KB_TEXT_SEARCH_SQLS_NO_FTS = tuple(
+    _kb_text_search_sql(n, with_fts=False) for n in range(_MAX_QUERY_WORDS + 1)
+)
+
+
+# Короткий TTL-кэш результатов поиска по БЗ: агент и оператор часто повторяют одни и те же
+# запросы, а БЗ меняется редко. Сбрасывается при записи в knowledge_base.
+_KB_SEARCH_CACHE_TTL_SEC = 30.0
+_KB_SEARCH_CACHE_MAXSIZE = 2048
+_kb_search_cache: OrderedDict[tuple, tuple[float, list[dict[str, Any]]]] = OrderedDict()
+_kb_search_cache_lock = threading.Lock()
+# Поколение кэша: растёт при каждом сбросе. Поиск, начатый до сброса, свой результат
+# (посчитанный по старой БЗ) в кэш уже не кладёт
+_kb_search_cache_generation = 0
+
+
+def clear_kb_search_cache() -> None:
+    global _kb_search_cache_generation
+    with _kb_search_cache_lock:
+        _kb_search_cache.clear()
+        _kb_search_cache_generation += 1
+
+
 def search_knowledge_base(
     query: str,
     limit: int = 5,
@@ -211,30 +410,54 @@ def search_knowledge_base(
     """
     Поиск по базе знаний. По умолчанию — полнотекст (russian).
     При use_vector=True и заполненных embedding — семантический поиск (pgvector).
+    Повторный запрос с теми же параметрами в течение _KB_SEARCH_CACHE_TTL_SEC отдаётся из кэша.
     """
     query = (query or "").strip()
     if not query:
         return []
     limit = max(1, min(limit, 20))
-    pattern = f"%{query.replace('%', '\\%').replace('_', '\\_')}%"
+    key = (query, limit, use_vector)
+    now = time.monotonic()
+    with _kb_search_cache_lock:
+        cached = _kb_search_cache.get(key)
+        if cached and cached[0] > now:
+            _kb_search_cache.move_to_end(key)
+            return [dict(r) for r in cached[1]]
+        generation = _kb_search_cache_generation
+
+    rows = _search_knowledge_base(query, limit, use_vector)
+    with _kb_search_cache_lock:
+        if generation != _kb_search_cache_generation:
+            return [dict(r) for r in rows]
+        _kb_search_cache[key] = (now + _KB_SEARCH_CACHE_TTL_SEC, rows)
+        _kb_search_cache.move_to_end(key)
+        while len(_kb_search_cache) > _KB_SEARCH_CACHE_MAXSIZE:
+            _kb_search_cache.popitem(last=False)
+    return [dict(r) for r in rows]
+
+
+def _search_knowledge_base(query: str, limit: int, use_vector: bool) -> list[dict[str, Any]]:
+    pattern = _like_pattern(query)
+    words = _query_words(query)
 
     if use_vector and get_embedding:
         emb = get_embedding(query)
         if emb and len(emb) == 384:
-            vec_str = "[" + ",".join(str(x) for x in emb) + "]"
             with get_connection() as conn:
+                vec = _vector_param(conn, emb)
                 with conn.cursor(row_factory=dict_row) as cur:
                     try:
                         cur.execute(
                             """
                             SELECT id, title, content, short_answer, category,
-                                   (1 - (embedding <=> %s::vector)) AS rank
+                                   (1 - (embedding <=> %s::vector))::float8 AS rank
                             FROM knowledge_base
                             WHERE is_active = TRUE AND embedding IS NOT NULL
                             ORDER BY embedding <=> %s::vector
                             LIMIT %s
                             """,
-                            (vec_str, vec_str, limit),
+                            (vec, vec, limit),
+                            prepare=True,
                         )
                         rows = cur.fetchall()
                         if rows:
@@ -242,99 +465,31 @@ def search_knowledge_base(
                     except Exception:
                         pass
 
+    params = {
+        "query": query,
+        "pattern": pattern,
+        "words": words,
+        "word_patterns": [_like_pattern(w) for w in words],
+        "limit": limit,
+    }
     with get_connection() as conn:
         with conn.cursor(row_factory=dict_row) as cur:
             try:
-                cur.execute(
-                    """
-                    SELECT
-                        id, title, content, short_answer, category,
-                        ts_rank(search_vector, plainto_tsquery('russian', %s)) AS rank
-                    FROM knowledge_base
-                    WHERE is_active = TRUE
-                      AND search_vector @@ plainto_tsquery('russian', %s)
-                    ORDER BY rank DESC
-                    LIMIT %s
-                    """,
-                    (query, query, limit),
-                )
-                rows = cur.fetchall()
-                if not rows:
-                    raise ValueError("no rows")
+                cur.execute(_KB_TEXT_SEARCH_SQLS[len(words)], params, prepare=True)
             except Exception:
-                rows = []
-            if not rows:
-                words = [
-                    w
-                    for w in re.split(r"\W+", query)
-                    if len(w) >= 2 and not any(c in w for c in "'&!()")
-                ]
-                words = words[:10]
-                if words:
-                    # OR по каждому слову через plainto_tsquery (надёжнее, чем to_tsquery с "a | b")
-                    or_ts = " | ".join(
-                        "plainto_tsquery('russian', %s)" for _ in words
-                    )
-                    try:
-                        cur.execute(
-                            f"""
-                            SELECT
-                                id, title, content, short_answer, category,
-                                1.0 AS rank
-                            FROM knowledge_base
-                            WHERE is_active = TRUE
-                              AND search_vector @@ ({or_ts})
-                            ORDER BY id
-                            LIMIT %s
-                            """,
-                            (*words, limit),
-                        )
-                        rows = cur.fetchall()
-                    except Exception:
-                        pass
-            if not rows:
-                try:
-                    cur.execute(
-                        """
-                        SELECT id, title, content, short_answer, category, 1.0 AS rank
-                        FROM knowledge_base
-                        WHERE is_active = TRUE
-                          AND (title ILIKE %s OR content ILIKE %s)
-                        LIMIT %s
-                        """,
-                        (pattern, pattern, limit),
-                    )
-                    rows = cur.fetchall()
-                except Exception:
-                    rows = []
-            if not rows and words:
-                for w in words:
-                    try:
-                        like_pat = f"%{w.replace('%', '\\%').replace('_', '\\_')}%"
-                        cur.execute(
-                            """
-                            SELECT id, title, content, short_answer, category, 1.0 AS rank
-                            FROM knowledge_base
-                            WHERE is_active = TRUE
-                              AND (title ILIKE %s OR content ILIKE %s)
-                            LIMIT %s
-                            """,
-                            (like_pat, like_pat, limit),
-                        )
-                        rows = cur.fetchall()
-                        if rows:
-                            break
-                    except Exception:
-                        continue
+                # Нет search_vector (старая схема) — остаются только ILIKE-ступени
+                cur.execute(_KB_TEXT_SEARCH_SQLS_NO_FTS[len(words)], params, prepare=True)
+            rows = cur.fetchall()
     return [_kb_row_to_dict(r) for r in rows]
 
 
 def fill_knowledge_base_embeddings() -> tuple[int, int]:
     """
     Заполняет колонку embedding для записей knowledge_base, где embedding IS NULL.
-    Использует HF Inference API (feature-extraction). Возвращает (обновлено, ошибок).
+    Использует HF Inference API (feature-extraction) пачками по _EMBEDDING_BATCH_SIZE текстов.
+    Возвращает (обновлено, ошибок).
     """
-    if not get_embedding:
+    if not get_embeddings:
         return 0, 0
     updated = 0
     errors = 0
@@ -345,7 +500,7 @@ def fill_knowledge_base_embeddings() -> tuple[int, int]:
                     "SELECT column_name FROM information_schema.columns "
                     "WHERE table_schema = 'public' AND table_name = 'knowledge_base'"
                 )
-                if "embedding" not in {r[0] for r in cur.fetchall()}:
+                if "embedding" not in {r["column_name"] for r in cur.fetchall()}:
                     return 0, 0
             except Exception:
                 return 0, 0
@@ -353,25 +508,30 @@ def fill_knowledge_base_embeddings() -> tuple[int, int]:
                 "SELECT id, title, content FROM knowledge_base WHERE embedding IS NULL"
             )
             rows = cur.fetchall()
-    for r in rows:
-        text = f"{r.get('title') or ''} {r.get('content') or ''}".strip()[:8192]
-        if not text:
-            continue
-        emb = get_embedding(text)
-        if not emb or len(emb) != 384:
-            errors += 1
+    items = [
+        (r["id"], text)
+        for r in rows
+        if (text := f"{r.get('title') or ''} {r.get('content') or ''}".strip()[:8192])
+    ]
+    for start in range(0, len(items), _EMBEDDING_BATCH_SIZE):
+        chunk = items[start:start + _EMBEDDING_BATCH_SIZE]
+        embeddings = get_embeddings([text for _, text in chunk])
+        ok = [(kb_id, emb) for (kb_id, _), emb in zip(chunk, embeddings) if emb and len(emb) == 384]
+        errors += len(chunk) - len(ok)
+        if not ok:
             continue
-        vec_str = "[" + ",".join(str(x) for x in emb) + "]"
         with get_connection() as conn:
             with conn.cursor() as cur:
                 try:
-                    cur.execute(
+                    cur.executemany(
                         "UPDATE knowledge_base SET embedding = %s::vector, updated_at = CURRENT_TIMESTAMP WHERE id = %s",
-                        (vec_str, r["id"]),
+                        [(_vector_param(conn, emb), kb_id) for kb_id, emb in ok],
                     )
-                    updated += 1
+                    updated += len(ok)
                 except Exception:
-                    errors += 1
+                    errors += len(ok)
+    if updated:
+        clear_kb_search_cache()
     return updated, errors
 
 
@@ -386,6 +546,7 @@ def create_kb_entry(
     embedding: list[float] | None = None,
 ) -> int:
     with get_connection() as conn:
+        vec = _vector_param(conn, embedding) if embedding else None
         with conn.cursor(row_factory=dict_row) as cur:
             cur.execute(
                 """
@@ -393,30 +554,18 @@ def create_kb_entry(
                 VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
                 RETURNING id
                 """,
-                (ticket_id, title, content, short_answer, category, tags or [], keywords or [], embedding),
+                (ticket_id, title, content, short_answer, category, tags or [], keywords or [], vec),
             )
             row = cur.fetchone()
 
             cur.execute(
-                "UPDATE tickets SET status = 'saved_to_kb', updated_at = %s WHERE id = %s",
-                (datetime.utcnow(), ticket_id),
+                "UPDATE tickets SET status = 'saved_to_kb', updated_at = CURRENT_TIMESTAMP WHERE id = %s",
+                (ticket_id,),
             )
+    clear_kb_search_cache()
     return int(row["id"])
 
 
-def incoming_email_already_processed(message_id: str | None) -> bool:
-    """Проверяет, обрабатывали ли мы уже входящее письмо с этим message_id (есть запись в email_log)."""
-    if not (message_id and str(message_id).strip()):
-        return False
-    with get_connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                "SELECT 1 FROM email_log WHERE message_id = %s AND direction = 'incoming' LIMIT 1",
-                (message_id.strip(),),
-            )
-            return cur.fetchone() is not None
-
-
 def create_email_log(
     ticket_id: int,
     raw_from: str,
@@ -428,29 +577,29 @@ def create_email_log(
     direction: str,
     send_status: str | None = None,
     error_text: str | None = None,
+    cur: Cursor | None = None,
 ) -> None:
-    with get_connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                INSERT INTO email_log (
-                    ticket_id, raw_from, raw_to, raw_subject, raw_body,
-                    message_id, in_reply_to, direction, send_status, error_text
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                """,
-                (
-                    ticket_id,
-                    raw_from,
-                    raw_to,
-                    raw_subject,
-                    raw_body,
-                    message_id,
-                    in_reply_to,
-                    direction,
-                    send_status,
-                    error_text,
-                ),
-            )
+    _execute_write(
+        cur,
+        """
+        INSERT INTO email_log (
+            ticket_id, raw_from, raw_to, raw_subject, raw_body,
+            message_id, in_reply_to, direction, send_status, error_text
+        ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        """,
+        (
+            ticket_id,
+            raw_from,
+            raw_to,
+            raw_subject,
+            raw_body,
+            message_id,
+            in_reply_to,
+            direction,
+            send_status,
+            error_text,
+        ),
+    )
 
 
 def search_kb_hybrid(
@@ -471,7 +620,7 @@ def search_kb_hybrid(
                       AND (
                             title ILIKE %s
                          OR content ILIKE %s
-                         OR search_vector @@ plainto_tsquery('simple', %s)
+                         OR search_vector @@ plainto_tsquery('russian', %s)
                       )
                     ORDER BY usage_count DESC, success_rate DESC, created_at DESC
                     LIMIT %s
@@ -496,30 +645,29 @@ def search_kb_hybrid(
                 return cur.fetchall()
 
 
-def log_ai_run(ticket_id: int, payload: dict[str, Any]) -> None:
-    with get_connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                INSERT INTO ai_run_log (
-                    ticket_id, pipeline_version, analyzer_model, generator_model, retriever_top_k,
-                    total_latency_ms, analyzer_latency_ms, retrieval_latency_ms,
-                    generator_latency_ms, guardrails_latency_ms, fallback_used, success, error_text
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                """,
-                (
-                    ticket_id,
-                    payload.get("pipeline_version") or "v1",
-                    payload.get("analyzer_model"),
-                    payload.get("generator_model"),
-                    payload.get("retriever_top_k"),
-                    payload.get("total_latency_ms"),
-                    payload.get("analyzer_latency_ms"),
-                    payload.get("retrieval_latency_ms"),
-                    payload.get("generator_latency_ms"),
-                    payload.get("guardrails_latency_ms"),
-                    payload.get("fallback_used", False),
-                    payload.get("success", True),
-                    payload.get("error_text"),
-                ),
-            )
+def log_ai_run(ticket_id: int, payload: dict[str, Any], cur: Cursor | None = None) -> None:
+    _execute_write(
+        cur,
+        """
+        INSERT INTO ai_run_log (
+            ticket_id, pipeline_version, analyzer_model, generator_model, retriever_top_k,
+            total_latency_ms, analyzer_latency_ms, retrieval_latency_ms,
+            generator_latency_ms, guardrails_latency_ms, fallback_used, success, error_text
+        ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        """,
+        (
+            ticket_id,
+            payload.get("pipeline_version") or "v1",
+            payload.get("analyzer_model"),
+            payload.get("generator_model"),
+            payload.get("retriever_top_k"),
+            payload.get("total_latency_ms"),
+            payload.get("analyzer_latency_ms"),
+            payload.get("retrieval_latency_ms"),
+            payload.get("generator_latency_ms"),
+            payload.get("guardrails_latency_ms"),
+            payload.get("fallback_used", False),
+            payload.get("success", True),
+            payload.get("error_text"),
+        ),
+    )
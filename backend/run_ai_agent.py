@@ -4,63 +4,90 @@
   python run_ai_agent.py
 Требуется запущенный backend на http://localhost:8000
 """
+import http.client
 import json
 import os
+import random
 import sys
 import time
-import urllib.request
-import urllib.error
+from urllib.parse import urlsplit
 
 API_BASE = os.getenv("AI_AGENT_API_BASE", "http://localhost:8000")
 INTERVAL_SEC = int(os.getenv("AI_AGENT_INTERVAL_SEC", "60"))
+# Пока ящик пуст (404), пауза удваивается до INTERVAL_SEC * MAX_BACKOFF_FACTOR
+MAX_BACKOFF_FACTOR = 5
+
+_api = urlsplit(API_BASE)
+_conn: http.client.HTTPConnection | None = None
+
+
+def _get_conn() -> http.client.HTTPConnection:
+    """Одно keep-alive соединение на всё время работы агента — без TCP/TLS-рукопожатия на каждый опрос."""
+    global _conn
+    if _conn is None:
+        conn_cls = http.client.HTTPSConnection if _api.scheme == "https" else http.client.HTTPConnection
+        _conn = conn_cls(_api.hostname, _api.port, timeout=300)
+    return _conn
+
+
+def _reset_conn() -> None:
+    global _conn
+    if _conn is not None:
+        _conn.close()
+        _conn = None
 
 
 def process_latest():
-    url = f"{API_BASE}/mvp/process-latest"
+    path = _api.path.rstrip("/") + "/mvp/process-latest"
     data = json.dumps({"mailbox": "INBOX"}).encode("utf-8")
-    req = urllib.request.Request(
-        url,
-        data=data,
-        headers={"Content-Type": "application/json; charset=utf-8"},
-        method="POST",
-    )
-    try:
-        with urllib.request.urlopen(req, timeout=300) as resp:
+    headers = {"Content-Type": "application/json; charset=utf-8"}
+    # Вторая попытка — если backend успел закрыть простаивавшее keep-alive соединение
+    for attempt in (1, 2):
+        try:
+            conn = _get_conn()
+            conn.request("POST", path, body=data, headers=headers)
+            resp = conn.getresponse()
             body = resp.read().decode("utf-8")
-            return resp.status, json.loads(body) if body else {}
-    except urllib.error.HTTPError as e:
-        body = e.read().decode("utf-8") if e.fp else ""
+        except (http.client.HTTPException, OSError) as e:
+            _reset_conn()
+            if attempt == 2:
+                return None, {"error": str(e)}
+            continue
+        except Exception as e:
+            _reset_conn()
+            return None, {"error": str(e)}
         try:
-            return e.code, json.loads(body) if body else {}
+            return resp.status, json.loads(body) if body else {}
         except json.JSONDecodeError:
-            return e.code, {"error": body}
-    except urllib.error.URLError as e:
-        return None, {"error": str(e.reason)}
-    except Exception as e:
-        return None, {"error": str(e)}
+            return resp.status, {"error": body}
 
 
 def main():
     print(f"AI-агент: опрос {API_BASE} каждые {INTERVAL_SEC} сек. Остановка: Ctrl+C")
+    delay = INTERVAL_SEC
     while True:
         try:
             status, result = process_latest()
             if status == 200:
+                delay = INTERVAL_SEC
                 print(
                     f"[OK] Обработано: от={result.get('source_from', '?')} "
                     f"тема={result.get('source_subject', '?')[:50]} "
                     f"ticket -> оператору"
                 )
             elif status == 404:
-                print("[--] В ящике нет писем, ждём...")
+                delay = min(delay * 2, INTERVAL_SEC * MAX_BACKOFF_FACTOR)
+                print(f"[--] В ящике нет писем, ждём {delay} сек...")
             elif status is not None:
                 print(f"[ERR] HTTP {status}: {result.get('error', result)}")
             else:
                 print(f"[ERR] {result.get('error', 'нет связи с backend')}")
+            # Джиттер ±10%, чтобы несколько агентов не опрашивали backend синхронно
+            time.sleep(delay * random.uniform(0.9, 1.1))
         except KeyboardInterrupt:
             print("\nОстановка агента.")
+            _reset_conn()
             sys.exit(0)
-        time.sleep(INTERVAL_SEC)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,87 @@
+# DDL, общий для backend/db.py (init_db при старте API) и init_database.py.
+# Только stdlib: init_database.py импортирует модуль без пула соединений и pgvector.
+
+
+def _search_vector_expr(config: str, col_a: str, col_b: str, row: str = "") -> str:
+    return (
+        f"setweight(to_tsvector('{config}', coalesce({row}{col_a}, '')), 'A') || "
+        f"setweight(to_tsvector('{config}', coalesce({row}{col_b}, '')), 'B')"
+    )
+
+
+def search_vector_backfill(table: str, config: str, col_a: str, col_b: str) -> str:
+    """Пересчёт search_vector всех строк — для колонки, только что добавленной к заполненной таблице."""
+    return f"UPDATE {table} SET search_vector = {_search_vector_expr(config, col_a, col_b)};"
+
+
+def search_vector_statements(table: str, config: str, col_a: str, col_b: str) -> list[str]:
+    """
+    search_vector ведётся триггером, а не GENERATED ... STORED: сгенерированная колонка
+    пересчитывается при любом UPDATE строки (статус, embedding, ответ ИИ), а триггер —
+    только когда в UPDATE участвуют исходные текстовые колонки.
+    """
+    func = f"{table}_search_vector_update"
+    backfill = search_vector_backfill(table, config, col_a, col_b)
+    return [
+        # Бэкфилл — только при смене способа расчёта, а не на каждом старте (полный проход по таблице):
+        # - колонка ещё GENERATED (старые БД, 'simple') — она становится обычной;
+        # - триггера ещё нет (колонка только что добавлена) или он считает с другим конфигом.
+        # Старый триггер снимается до UPDATE, чтобы не пересчитать строки своим конфигом.
+        f"""
+        DO $$
+        BEGIN
+            IF EXISTS (
+                SELECT 1 FROM pg_attribute
+                WHERE attrelid = to_regclass('public.{table}') AND attname = 'search_vector'
+                  AND attgenerated <> '' AND NOT attisdropped
+            ) THEN
+                ALTER TABLE {table} ALTER COLUMN search_vector DROP EXPRESSION;
+                {backfill}
+            ELSIF NOT EXISTS (
+                SELECT 1 FROM pg_proc
+                WHERE proname = '{func}' AND prosrc LIKE '%''{config}''%'
+            ) THEN
+                DROP TRIGGER IF EXISTS {func} ON {table};
+                {backfill}
+            END IF;
+        END
+        $$;
+        """,
+        f"""
+        CREATE OR REPLACE FUNCTION {func}() RETURNS trigger AS $$
+        BEGIN
+            NEW.search_vector := {_search_vector_expr(config, col_a, col_b, row="NEW.")};
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql;
+        """,
+        f"DROP TRIGGER IF EXISTS {func} ON {table};",
+        f"""
+        CREATE TRIGGER {func}
+        BEFORE INSERT OR UPDATE OF {col_a}, {col_b} ON {table}
+        FOR EACH ROW EXECUTE FUNCTION {func}();
+        """,
+    ]
+
+
+# CREATE TABLE knowledge_base в двух вариантах — с колонкой embedding (pgvector установлен) и без
+KB_CREATE_SQL = """
+CREATE TABLE IF NOT EXISTS knowledge_base (
+    id SERIAL PRIMARY KEY,
+    ticket_id INTEGER REFERENCES tickets(id) ON DELETE SET NULL,
+    title VARCHAR(500) NOT NULL,
+    content TEXT NOT NULL,
+    short_answer TEXT,
+    tags TEXT[],
+    category VARCHAR(100),
+    usage_count INTEGER DEFAULT 0,
+    success_rate FLOAT DEFAULT 1.0,
+    keywords TEXT[],
+    {embedding}is_active BOOLEAN DEFAULT TRUE,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    search_vector tsvector
+);
+"""
+KB_CREATE_WITH_VECTOR = KB_CREATE_SQL.format(embedding="embedding vector(384),\n    ")
+KB_CREATE_NO_VECTOR = KB_CREATE_SQL.format(embedding="")
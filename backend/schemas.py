@@ -1,7 +1,12 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter
+
+# Тела запросов только читаются в обработчике: неизменяемые, без лишних полей
+_REQUEST_CONFIG = ConfigDict(frozen=True, extra="forbid")
 
 
 class SendEmailRequest(BaseModel):
+    model_config = _REQUEST_CONFIG
+
     to: str = Field(..., description="Адрес получателя")
     subject: str = Field(..., description="Тема письма")
     body: str = Field(..., description="Текст письма")
@@ -15,6 +20,8 @@ class SendEmailResponse(BaseModel):
 
 
 class ProcessLatestEmailRequest(BaseModel):
+    model_config = _REQUEST_CONFIG
+
     mailbox: str = Field("INBOX", description="Папка, из которой берём последнее письмо")
     operator_email: str | None = Field(
         None,
@@ -24,6 +31,8 @@ class ProcessLatestEmailRequest(BaseModel):
 
 class ProcessDemoRequest(BaseModel):
     """Демо-письмо без реальной почты: создаёт тикет и обрабатывает ИИ."""
+    model_config = _REQUEST_CONFIG
+
     subject: str | None = Field(None, description="Тема письма")
     body: str | None = Field(None, description="Текст письма")
     from_addr: str | None = Field(None, description="Email отправителя")
@@ -50,6 +59,8 @@ class ProcessLatestEmailResponse(BaseModel):
 
 
 class ProcessBatchEmailsRequest(BaseModel):
+    model_config = _REQUEST_CONFIG
+
     mailbox: str = Field("INBOX", description="Папка, из которой берём письма")
     limit: int = Field(5, ge=1, le=50, description="Сколько последних писем обработать")
     operator_email: str | None = Field(
@@ -63,12 +74,15 @@ class ProcessBatchEmailsResponse(BaseModel):
     ok: bool
     processed_count: int
     ticket_ids: list[int] = Field(default_factory=list)
+    skipped_count: int = 0
     failed_count: int = 0
     operator_email: str | None = None
     digest_sent: bool = False
 
 
 class UpdateTicketRequest(BaseModel):
+    model_config = _REQUEST_CONFIG
+
     client_name: str | None = None
     phone: str | None = None
     location_object: str | None = None
@@ -82,17 +96,21 @@ class UpdateTicketRequest(BaseModel):
 
 
 class ReplyTicketRequest(BaseModel):
+    model_config = _REQUEST_CONFIG
+
     to_email: str | None = Field(None, description="Если не задано, берется email клиента из тикета")
     subject: str | None = Field(None, description="Если не задано, будет Re: тема тикета")
     body: str = Field(..., description="Финальный ответ оператора")
 
 
 class SaveToKbRequest(BaseModel):
+    model_config = _REQUEST_CONFIG
+
     title: str | None = None
     content: str | None = None
     short_answer: str | None = None
     category: str | None = None
-    tags: list[str] | None = None
+    tags: tuple[str, ...] | None = None
 
 
 class KnowledgeBaseEntry(BaseModel):
@@ -112,8 +130,14 @@ class KnowledgeBaseSearchResponse(BaseModel):
     entries: list[KnowledgeBaseEntry]
 
 
+# Валидатор списка записей БЗ строится один раз при импорте и переиспользуется в поиске
+KB_ENTRIES_ADAPTER = TypeAdapter(list[KnowledgeBaseEntry])
+
+
 class KbAskRequest(BaseModel):
     """Запрос ответа на вопрос клиента (поиск в БЗ + Qwen)."""
+    model_config = _REQUEST_CONFIG
+
     question: str = Field(..., min_length=1, description="Вопрос клиента")
     limit: int = Field(5, ge=1, le=10, description="Сколько записей из БЗ подставлять в контекст")
     use_vector: bool = Field(False, description="Семантический поиск по эмбеддингам (если заполнены)")
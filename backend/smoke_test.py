@@ -5,39 +5,63 @@
 """
 
 import argparse
+import http.client
 import json
 import sys
-from urllib import request
+from urllib.parse import urlsplit
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-def http_json(method: str, url: str, payload: dict | None = None):
+
+def _dumps(payload) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload).encode("utf-8")
+
+
+def _loads(body: bytes):
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body.decode("utf-8"))
+
+
+def http_json(conn: http.client.HTTPConnection, method: str, path: str, payload: dict | None = None):
+    """Запрос по общему keep-alive соединению (один TCP-handshake на весь сценарий)."""
     data = None
     headers = {"Content-Type": "application/json; charset=utf-8"}
     if payload is not None:
-        data = json.dumps(payload).encode("utf-8")
-    req = request.Request(url, data=data, method=method, headers=headers)
-    with request.urlopen(req, timeout=30) as resp:
-        body = resp.read().decode("utf-8")
-        return resp.status, json.loads(body) if body else {}
+        data = _dumps(payload)
+    conn.request(method, path, body=data, headers=headers)
+    resp = conn.getresponse()
+    body = resp.read()
+    if resp.status >= 400:
+        raise RuntimeError(f"HTTP {resp.status} {method} {path}: {body[:300].decode('utf-8', 'replace')}")
+    return resp.status, _loads(body) if body else {}
 
 
 def main() -> int:
     parser = argparse.ArgumentParser()
     parser.add_argument("--base-url", default="http://localhost:8000")
     args = parser.parse_args()
-    base = args.base_url.rstrip("/")
+    base = urlsplit(args.base_url)
+    conn_cls = http.client.HTTPSConnection if base.scheme == "https" else http.client.HTTPConnection
+    conn = conn_cls(base.hostname or "localhost", base.port, timeout=30)
+    prefix = base.path.rstrip("/")
 
     try:
         print("1) health")
-        _, health = http_json("GET", f"{base}/health")
+        _, health = http_json(conn, "GET", f"{prefix}/health")
         print(health)
 
         print("2) ingest emails")
-        _, ingest = http_json("POST", f"{base}/emails/ingest?limit=3&mailbox=INBOX")
+        _, ingest = http_json(conn, "POST", f"{prefix}/emails/ingest?limit=3&mailbox=INBOX")
         print(ingest)
 
         print("3) get tickets")
-        _, tickets = http_json("GET", f"{base}/tickets?limit=5")
+        _, tickets = http_json(conn, "GET", f"{prefix}/tickets?limit=5")
         print(f"tickets: {len(tickets)}")
         if not tickets:
             print("Нет тикетов после ingest")
@@ -47,18 +71,21 @@ def main() -> int:
 
         print("4) patch ticket")
         _, patched = http_json(
+            conn,
             "PATCH",
-            f"{base}/tickets/{ticket_id}",
+            f"{prefix}/tickets/{ticket_id}",
             {"status": "drafted", "needs_attention": False},
         )
         print({"id": patched.get("id"), "status": patched.get("status")})
 
         print("5) save ticket to kb")
-        _, kb = http_json("POST", f"{base}/tickets/{ticket_id}/save-to-kb", {})
+        _, kb = http_json(conn, "POST", f"{prefix}/tickets/{ticket_id}/save-to-kb", {})
         print(kb)
     except Exception as exc:
         print("SMOKE FAILED:", exc)
         return 1
+    finally:
+        conn.close()
 
     print("SMOKE OK")
     return 0
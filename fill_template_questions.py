@@ -3,6 +3,9 @@
 Заполняет в kb_test.xlsx колонку tags шаблонными вопросами для каждой темы.
 Шаблонные вопросы — примеры запросов пользователя, которые могут привести к этой теме.
 """
+import re
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 
 try:
@@ -22,11 +25,90 @@ def _normalize_header(h):
     return str(h).strip().lower().replace(" ", "_")
 
 
+# Правила: (варианты условия, вопросы). Условие выполнено, если в заголовке есть все слова
+# хотя бы одного варианта.
+_TEMPLATE_RULES: tuple[tuple[tuple[tuple[str, ...], ...], tuple[str, ...]], ...] = (
+    ((("назначение",), ("назначен",)), (
+        "Для чего это нужно?",
+        "Что это такое?",
+    )),
+    ((("органы управления",), ("управлен",)), (
+        "Где кнопки управления?",
+        "Как управлять?",
+    )),
+    ((("частота", "миган"),), (
+        "Как часто мигает?",
+        "Частота мигания индикатора",
+    )),
+    ((("звуковая сигнализация",), ("нештатн",)), (
+        "Что делать при срабатывании звуковой сигнализации?",
+        "Как отключить звуковой сигнал?",
+    )),
+    ((("настройка", "адрес"), ("настройка", "скорост"), ("настройка", "rs-232"), ("настройка", "rs-485")), (
+        "Как настроить сетевой адрес?",
+        "Как изменить скорость RS-485?",
+    )),
+    ((("уровн", "доступ"), ("пароль",)), (
+        "Как установить пароль?",
+        "Где сменить пароль доступа?",
+    )),
+    ((("режим обслуживания",), ("обслуживание канала",)), (
+        "Как включить режим обслуживания?",
+        "Режим обслуживания канала",
+    )),
+    ((("неисправность",), ("авария",), ("светит",)), (
+        "Что делать если светит авария?",
+        "Почему горит авария?",
+        "Как снять аварию?",
+    )),
+    ((("сброс", "программ"),), (
+        "Как сбросить программу?",
+        "Как сделать сброс настроек?",
+    )),
+    ((("периодичность",), ("техническое обслуживание",)), (
+        "Как часто проводить обслуживание?",
+        "Когда делать ТО?",
+    )),
+    ((("очистка", "архив"),), (
+        "Как очистить архив?",
+        "Как удалить старые данные?",
+    )),
+    ((("кабель",), ("подключен", "датчик")), (
+        "Какой кабель нужен для датчика?",
+        "Требования к кабелю подключения",
+    )),
+)
+
+_KEYWORDS = sorted(
+    {kw for variants, _ in _TEMPLATE_RULES for variant in variants for kw in variant},
+    key=len,
+    reverse=True,
+)
+# Один проход regex по заголовку вместо десятков проверок `in`. Lookahead находит и
+# перекрывающиеся вхождения; из слов, начинающихся в одной позиции, берётся самое длинное,
+# а вложенные в него слова (назначен ⊂ назначение) добавляются через _KEYWORD_IMPLIES.
+_KEYWORDS_RE = re.compile("(?=(" + "|".join(map(re.escape, _KEYWORDS)) + "))")
+_KEYWORD_IMPLIES = {kw: frozenset(k for k in _KEYWORDS if k in kw) for kw in _KEYWORDS}
+
+
+def _find_keywords(t_lower: str) -> set[str]:
+    hits: set[str] = set()
+    for m in _KEYWORDS_RE.finditer(t_lower):
+        hits |= _KEYWORD_IMPLIES[m.group(1)]
+    return hits
+
+
 def generate_template_questions(title: str, category: str = "") -> list[str]:
     """По заголовку темы формирует список шаблонных вопросов, которые могут к ней привести."""
     t = (title or "").strip()
     if not t:
         return []
+    return list(_template_questions(t))
+
+
+# В книге много строк с одинаковыми заголовками (одно семейство приборов) — считаем один раз
+@lru_cache(maxsize=4096)
+def _template_questions(t: str) -> tuple[str, ...]:
     questions = []
     t_lower = t.lower()
 
@@ -34,67 +116,11 @@ def generate_template_questions(title: str, category: str = "") -> list[str]:
     questions.append(t)
 
     # По ключевым словам добавляем типичные формулировки пользователей
-    if "назначение" in t_lower or "назначен" in t_lower:
-        questions.extend([
-            "Для чего это нужно?",
-            "Что это такое?",
-        ])
-    if "органы управления" in t_lower or "управлен" in t_lower:
-        questions.extend([
-            "Где кнопки управления?",
-            "Как управлять?",
-        ])
-    if "частота" in t_lower and "миган" in t_lower:
-        questions.extend([
-            "Как часто мигает?",
-            "Частота мигания индикатора",
-        ])
-    if "звуковая сигнализация" in t_lower or "нештатн" in t_lower:
-        questions.extend([
-            "Что делать при срабатывании звуковой сигнализации?",
-            "Как отключить звуковой сигнал?",
-        ])
-    if "настройка" in t_lower and ("адрес" in t_lower or "скорост" in t_lower or "rs-232" in t_lower or "rs-485" in t_lower):
-        questions.extend([
-            "Как настроить сетевой адрес?",
-            "Как изменить скорость RS-485?",
-        ])
-    if "уровн" in t_lower and "доступ" in t_lower or "пароль" in t_lower:
-        questions.extend([
-            "Как установить пароль?",
-            "Где сменить пароль доступа?",
-        ])
-    if "режим обслуживания" in t_lower or "обслуживание канала" in t_lower:
-        questions.extend([
-            "Как включить режим обслуживания?",
-            "Режим обслуживания канала",
-        ])
-    if "неисправность" in t_lower or "авария" in t_lower or "светит" in t_lower:
-        questions.extend([
-            "Что делать если светит авария?",
-            "Почему горит авария?",
-            "Как снять аварию?",
-        ])
-    if "сброс" in t_lower and "программ" in t_lower:
-        questions.extend([
-            "Как сбросить программу?",
-            "Как сделать сброс настроек?",
-        ])
-    if "периодичность" in t_lower or "техническое обслуживание" in t_lower:
-        questions.extend([
-            "Как часто проводить обслуживание?",
-            "Когда делать ТО?",
-        ])
-    if "очистка" in t_lower and "архив" in t_lower:
-        questions.extend([
-            "Как очистить архив?",
-            "Как удалить старые данные?",
-        ])
-    if "кабель" in t_lower or "подключен" in t_lower and "датчик" in t_lower:
-        questions.extend([
-            "Какой кабель нужен для датчика?",
-            "Требования к кабелю подключения",
-        ])
+    hits = _find_keywords(t_lower)
+    if hits:
+        for variants, rule_questions in _TEMPLATE_RULES:
+            if any(hits.issuperset(variant) for variant in variants):
+                questions.extend(rule_questions)
 
     # Универсальные варианты, если мало набралось
     if len(questions) <= 1:
@@ -104,15 +130,25 @@ def generate_template_questions(title: str, category: str = "") -> list[str]:
             questions.append(f"Как {t_lower}?")
         questions.append(f"Расскажите про {t_lower}")
 
-    # Убираем дубликаты с сохранением порядка
-    seen = set()
-    unique = []
-    for q in questions:
-        q_clean = q.strip()
-        if q_clean and q_clean not in seen:
-            seen.add(q_clean)
-            unique.append(q_clean)
-    return unique[:8]
+    # Убираем дубликаты с сохранением порядка (dict.fromkeys — цикл целиком на C)
+    return tuple(dict.fromkeys(q for q in map(str.strip, questions) if q))[:8]
+
+
+# Ниже этого числа разных заголовков запуск процессов дороже самой генерации
+PARALLEL_MIN_TITLES = 5000
+
+
+def _tags_text(title: str) -> str:
+    return "; ".join(generate_template_questions(title))
+
+
+def _generate_all(titles) -> dict[str, str]:
+    """Текст для колонки tags по каждому заголовку; на больших книгах — параллельно по ядрам."""
+    titles = list(titles)
+    if len(titles) < PARALLEL_MIN_TITLES:
+        return {t: _tags_text(t) for t in titles}
+    with ProcessPoolExecutor() as ex:
+        return dict(zip(titles, ex.map(_tags_text, titles, chunksize=256)))
 
 
 def main():
@@ -126,15 +162,13 @@ def main():
         print("Нет активного листа.")
         return 1
 
-    headers = [_normalize_header(cell.value) for cell in ws[1]]
+    header_row = next(ws.iter_rows(min_row=1, max_row=1, values_only=True), ())
+    headers = [_normalize_header(v) for v in header_row]
     title_idx = -1
-    category_idx = -1
     tags_idx = -1
     for i, h in enumerate(headers):
         if h in ("title", "заголовок", "вопрос", "question", "question_template"):
             title_idx = i
-        if h in ("category", "категория"):
-            category_idx = i
         if h in ("tags", "теги"):
             tags_idx = i
     if title_idx < 0:
@@ -151,22 +185,34 @@ def main():
 
     tags_col = tags_idx + 1
 
-    filled = 0
-    for row_idx in range(2, ws.max_row + 1):
-        title_val = ws.cell(row=row_idx, column=title_idx + 1).value
+    # Читаем только значения (без объектов Cell), записываем — вторым проходом
+    rows = []
+    for row_idx, row in enumerate(ws.iter_rows(min_row=2, values_only=True), start=2):
+        title_val = row[title_idx] if title_idx < len(row) else None
         title = (title_val if isinstance(title_val, str) else str(title_val or "")).strip()
         if not title:
             continue
-        category_val = ""
-        if category_idx >= 0:
-            cat_cell = ws.cell(row=row_idx, column=category_idx + 1).value
-            category_val = (cat_cell if isinstance(cat_cell, str) else str(cat_cell or "")).strip()
-        questions = generate_template_questions(title, category_val)
-        ws.cell(row=row_idx, column=tags_col, value="; ".join(questions))
-        filled += 1
-
-    wb.save(KB_XLSX)
-    print(f"Заполнены шаблонные вопросы в колонке tags для {filled} тем в {KB_XLSX}")
+        current = row[tags_idx] if tags_idx < len(row) else None
+        rows.append((row_idx, title, current))
+
+    tags_by_title = _generate_all(dict.fromkeys(title for _, title, _ in rows))
+    filled = len(rows)
+    # Совпадающие значения не трогаем: меньше ячеек на запись, а без изменений файл не пересохраняем
+    updates = [
+        (row_idx, tags_by_title[title])
+        for row_idx, title, current in rows
+        if current != tags_by_title[title]
+    ]
+
+    for row_idx, tags_text in updates:
+        ws.cell(row=row_idx, column=tags_col, value=tags_text)
+
+    if updates:
+        wb.save(KB_XLSX)
+    print(
+        f"Заполнены шаблонные вопросы в колонке tags для {filled} тем в {KB_XLSX} "
+        f"(изменено строк: {len(updates)})"
+    )
     return 0
 
 
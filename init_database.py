@@ -1,24 +1,37 @@
 import argparse
-import csv
 import getpass
 import os
+import re
 import sys
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from pathlib import Path
-from typing import Iterable, Optional
+from typing import Collection, Iterable, Iterator, Optional
 
 try:
     import openpyxl
 except ImportError:
     openpyxl = None  # type: ignore
 
+try:
+    # Быстрое чтение xlsx (Rust); при отсутствии читаем через openpyxl
+    from python_calamine import CalamineWorkbook
+except ImportError:
+    CalamineWorkbook = None  # type: ignore
+
+# Корень проекта вычисляется один раз, остальные пути — от него
+_project_root = Path(__file__).resolve().parent
+
 # Подгрузка backend/.env, чтобы PGHOST, PGPORT, PGUSER, PGPASSWORD, PGDATABASE были заданы
-_env_path = Path(__file__).resolve().parent / "backend" / ".env"
+_env_path = _project_root / "backend" / ".env"
 try:
     from dotenv import load_dotenv
     if _env_path.exists():
         load_dotenv(_env_path, encoding="utf-8")
-    load_dotenv(encoding="utf-8")
+    else:
+        # Поиск .env вверх по каталогам — только если backend/.env нет
+        load_dotenv(encoding="utf-8")
 except ImportError:
     pass
 
@@ -26,17 +39,66 @@ import psycopg
 from psycopg import Connection as PgConnection
 from psycopg import sql
 
+# Триггер search_vector и CREATE TABLE knowledge_base — одна копия в backend/schema_ddl.py:
+# обе инициализации пишут одни и те же объекты БД и не должны расходиться
+sys.path.insert(0, str(_project_root / "backend"))
+from schema_ddl import (  # noqa: E402
+    KB_CREATE_NO_VECTOR,
+    KB_CREATE_WITH_VECTOR,
+    search_vector_backfill,
+    search_vector_statements,
+)
+
 
-_project_root = Path(__file__).resolve().parent
 KB_XLSX_PATH = _project_root / "kb_test.xlsx"
 if not KB_XLSX_PATH.exists():
     KB_XLSX_PATH = _project_root.parent / "kb_test.xlsx"
 
 
+# GIN-индексы knowledge_base: при полной перезагрузке БЗ дешевле построить их один раз после
+# загрузки, чем обновлять на каждой вставленной строке
+KB_GIN_INDEXES = (
+    ("idx_kb_tags", "CREATE INDEX IF NOT EXISTS idx_kb_tags ON knowledge_base USING GIN (tags);"),
+    ("idx_kb_search", "CREATE INDEX IF NOT EXISTS idx_kb_search ON knowledge_base USING GIN (search_vector);"),
+    ("idx_kb_title_trgm", "CREATE INDEX IF NOT EXISTS idx_kb_title_trgm ON knowledge_base USING GIN (title gin_trgm_ops);"),
+    ("idx_kb_content_trgm", "CREATE INDEX IF NOT EXISTS idx_kb_content_trgm ON knowledge_base USING GIN (content gin_trgm_ops);"),
+)
+
+# Разделители шаблонных вопросов в ячейке: «|», «,» или «;»
+_TAG_SPLIT_RE = re.compile(r"[|,;]")
+
+
 def _normalize_header(h: Optional[str]) -> str:
     return (h or "").strip().lower().replace(" ", "_")
 
 
+def _iter_xlsx_rows(path: Path) -> Iterator[tuple]:
+    """Строки первого листа как кортежи значений: python-calamine, если установлен, иначе openpyxl read_only."""
+    if CalamineWorkbook is not None:
+        sheet = CalamineWorkbook.from_path(str(path)).get_sheet_by_index(0)
+        for row in sheet.to_python(skip_empty_area=False):
+            yield tuple(row)
+        return
+    wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        ws = wb.active
+        if ws:
+            # Размеры листа из файла бывают завышены (форматирование «до конца листа») —
+            # сбрасываем их и читаем только столбцы, у которых есть заголовок
+            ws.reset_dimensions()
+            header = next(ws.iter_rows(max_row=1, values_only=True), None)
+            if header is None:
+                return
+            width = len(header)
+            while width and header[width - 1] is None:
+                width -= 1
+            yield header[:width]
+            if width:
+                yield from ws.iter_rows(min_row=2, max_col=width, values_only=True)
+    finally:
+        wb.close()
+
+
 def _seed_kb_from_xlsx(conn: PgConnection) -> None:
     """Заполняет knowledge_base из kb_test.xlsx: очищает старую вставку и вставляет строки из файла.
     В колонку tags попадают шаблонные вопросы — примеры запросов пользователя, которые могут
@@ -50,134 +112,216 @@ def _seed_kb_from_xlsx(conn: PgConnection) -> None:
             cur.execute("SELECT COUNT(*) FROM knowledge_base")
             print(f"Записей в knowledge_base: {cur.fetchone()[0]}")
         return
-    if not openpyxl:
+    if not openpyxl and CalamineWorkbook is None:
         print("Установите openpyxl для чтения xlsx: pip install openpyxl")
         return
 
-    wb = openpyxl.load_workbook(KB_XLSX_PATH, read_only=True, data_only=True)
-    ws = wb.active
-    if not ws:
-        wb.close()
-        print("В книге нет активного листа.")
-        return
-    rows_iter = ws.iter_rows(values_only=True)
+    rows_iter = _iter_xlsx_rows(KB_XLSX_PATH)
     header_row = next(rows_iter, None)
     if not header_row:
-        wb.close()
+        rows_iter.close()
         print("Файл пустой.")
         return
-    headers = [_normalize_header(str(h)) for h in header_row]
+    # Заголовок → индекс (первое вхождение), один раз вместо линейного поиска на каждый ключ
+    header_idx: dict[str, int] = {}
+    for i, h in enumerate(header_row):
+        header_idx.setdefault(_normalize_header(str(h)), i)
     # Маппинг возможных названий колонок -> поля БД
     # tags в БД = шаблонные вопросы (примеры запросов пользователя, которые приводят к этой теме)
     title_keys = ("question_template", "question", "вопрос", "title", "заголовок")
     content_keys = ("answer_template", "answer", "ответ", "content", "содержание", "текст")
-    cat_key = "category"
-    if "категория" in headers:
-        cat_key = "категория"
+    cat_keys = ("категория", "category")
     # Колонка с шаблонными вопросами (приводящими к этой теме); при отсутствии используем title
     template_questions_keys = ("шаблонные_вопросы", "template_questions", "примеры_вопросов", "теги", "tags")
 
     def col_index(keys: tuple) -> int:
-        for k in keys:
-            if k in headers:
-                return headers.index(k)
-        return -1
+        return next((header_idx[k] for k in keys if k in header_idx), -1)
 
     title_idx = col_index(title_keys)
     content_idx = col_index(content_keys)
-    cat_idx = headers.index(cat_key) if cat_key in headers else -1
+    cat_idx = col_index(cat_keys)
     template_questions_idx = col_index(template_questions_keys)
 
     if title_idx < 0 or content_idx < 0:
-        wb.close()
+        rows_iter.close()
         print("В xlsx нужны колонки для вопроса (question_template/question/вопрос/title) и ответа (answer_template/answer/ответ/content).")
         return
 
-    rows = []
-    for row in rows_iter:
-        if not row or len(row) <= max(title_idx, content_idx):
-            continue
-        title_val = row[title_idx]
-        content_val = row[content_idx]
-        title = (title_val if title_val is not None else "").strip() if isinstance(title_val, str) else str(title_val or "").strip()
-        content = (content_val if content_val is not None else "").strip() if isinstance(content_val, str) else str(content_val or "").strip()
-        if not title or not content:
-            continue
-        short = content[:500] if len(content) > 500 else content
-        cat = None
-        if cat_idx >= 0 and cat_idx < len(row) and row[cat_idx] is not None:
-            cat = str(row[cat_idx]).strip() or None
-        # Шаблонные вопросы: фразы, которые пользователь мог бы спросить и попасть на эту тему
-        tags_list = []
-        if template_questions_idx >= 0 and template_questions_idx < len(row) and row[template_questions_idx]:
-            raw = str(row[template_questions_idx]).strip()
-            for s in raw.replace("|", ";").replace(",", ";").split(";"):
-                t = s.strip()
-                if t:
-                    tags_list.append(t)
-        if not tags_list:
-            tags_list = [title]
-        rows.append((title, content, short, tags_list, cat))
-    wb.close()
-
-    if not rows:
-        print("В xlsx нет подходящих строк (заполнены вопрос и ответ).")
-        with conn.cursor() as cur:
-            cur.execute("SELECT COUNT(*) FROM knowledge_base")
-            print(f"Записей в knowledge_base: {cur.fetchone()[0]}")
-        return
+    # Всё, что не меняется от строки к строке, считаем до цикла
+    min_len = max(title_idx, content_idx) + 1
+    use_cat = cat_idx >= 0
+    use_tq = template_questions_idx >= 0
+
+    def clean(v) -> str:
+        return v.strip() if type(v) is str else (str(v).strip() if v else "")
+
+    def parse_rows(source: Iterable[tuple]) -> Iterator[tuple]:
+        """Строки xlsx → (title, content, short, tags, cat) по мере чтения, без промежуточного списка."""
+        for row in source:
+            n = len(row) if row else 0
+            if n < min_len:
+                continue
+            title = clean(row[title_idx])
+            content = clean(row[content_idx])
+            if not title or not content:
+                continue
+            cat = None
+            if use_cat and cat_idx < n and row[cat_idx] is not None:
+                cat = str(row[cat_idx]).strip() or None
+            # Шаблонные вопросы: фразы, которые пользователь мог бы спросить и попасть на эту тему
+            tags_list = None
+            if use_tq and template_questions_idx < n and row[template_questions_idx]:
+                raw = str(row[template_questions_idx])
+                tags_list = [t for t in (s.strip() for s in _TAG_SPLIT_RE.split(raw)) if t]
+            yield (title, content, content[:500], tags_list or [title], cat)
 
     with conn.cursor() as cur:
-        cur.execute("DELETE FROM knowledge_base")
-        deleted = cur.rowcount
-        print(f"Удалено предыдущих записей в knowledge_base: {deleted}")
-
-        # Проверяем наличие колонки keywords
-        cur.execute("""
-            SELECT column_name FROM information_schema.columns
-            WHERE table_schema = 'public' AND table_name = 'knowledge_base'
-        """)
+        # Проверяем наличие колонок keywords/embedding — напрямую по pg_attribute
+        cur.execute(
+            """
+            SELECT attname FROM pg_attribute
+            WHERE attrelid = 'public.knowledge_base'::regclass
+              AND attname = ANY(%s) AND attnum > 0 AND NOT attisdropped
+            """,
+            (["keywords", "embedding"],),
+        )
         cols = {r[0] for r in cur.fetchall()}
         has_keywords = "keywords" in cols
         has_embedding = "embedding" in cols
 
-        def do_insert(row: tuple) -> None:
-            t, c, s, tags, cat = row
-            if has_embedding and has_keywords:
-                cur.execute(
-                    "INSERT INTO knowledge_base (title, content, short_answer, tags, category, keywords, embedding) VALUES (%s, %s, %s, %s, %s, %s, NULL)",
-                    (t, c, s, tags, cat or None, tags),
-                )
-            elif has_embedding:
-                cur.execute(
-                    "INSERT INTO knowledge_base (title, content, short_answer, tags, category, embedding) VALUES (%s, %s, %s, %s, %s, NULL)",
-                    (t, c, s, tags, cat or None),
-                )
-            elif has_keywords:
-                cur.execute(
-                    "INSERT INTO knowledge_base (title, content, short_answer, tags, category, keywords) VALUES (%s, %s, %s, %s, %s, %s)",
-                    (t, c, s, tags, cat or None, tags),
-                )
-            else:
-                cur.execute(
-                    "INSERT INTO knowledge_base (title, content, short_answer, tags, category) VALUES (%s, %s, %s, %s, %s)",
-                    (t, c, s, tags, cat or None),
-                )
+        # embedding не передаём — остаётся NULL (заполняется позже)
+        columns = ["title", "content", "short_answer", "tags", "category"]
+        if has_keywords:
+            columns.append("keywords")
+        columns_sql = sql.SQL(", ").join(map(sql.Identifier, columns))
+
+        # Вид строки выбирается один раз, а не проверкой флага на каждой строке.
+        # parse_rows уже отдаёт cat как None или непустую строку.
+        if has_keywords:
+            def db_row(row: tuple) -> tuple:
+                return (*row, row[3])  # keywords = tags
+        else:
+            def db_row(row: tuple) -> tuple:
+                return row
+
+        # Очистка и загрузка — одной транзакцией: при ошибке (или пустом файле) старая БЗ остаётся на месте
+        loaded = 0
+        with conn.transaction() as tx:
+            cur.execute(
+                """
+                SELECT indexname FROM pg_indexes
+                WHERE schemaname = 'public' AND tablename = 'knowledge_base' AND indexname = ANY(%s)
+                """,
+                ([name for name, _ in KB_GIN_INDEXES],),
+            )
+            existing_indexes = {r[0] for r in cur.fetchall()}
+            rebuild_indexes = [(name, stmt) for name, stmt in KB_GIN_INDEXES if name in existing_indexes]
+            # Только в этой транзакции: больше памяти на итоговую сборку GIN и без ожидания
+            # fsync WAL при COMMIT (скрипт инициализации: при сбое БЗ просто загрузят заново)
+            cur.execute(
+                "SET LOCAL synchronous_commit = off; "
+                "SET LOCAL maintenance_work_mem = '256MB'; "
+                "SET LOCAL work_mem = '64MB'; "
+                # GIN-индексы пересобираются уже по загруженным данным — пусть строятся параллельно
+                "SET LOCAL max_parallel_maintenance_workers = 4;"
+            )
+            for name, _ in rebuild_indexes:
+                cur.execute(sql.SQL("DROP INDEX IF EXISTS {}").format(sql.Identifier(name)))
+
+            # feedback — единственная таблица со ссылкой на knowledge_base. Если она пуста (чистая БД),
+            # БЗ можно очистить TRUNCATE и грузить COPY ... FREEZE: строки пишутся сразу «замороженными»,
+            # без последующего VACUUM FREEZE. FREEZE требует TRUNCATE в той же подтранзакции, что и COPY.
+            cur.execute("SELECT NOT EXISTS (SELECT 1 FROM feedback)")
+            can_freeze = cur.fetchone()[0]
+
+            def clear_kb(truncate: bool) -> int:
+                if not truncate:
+                    cur.execute("DELETE FROM knowledge_base")
+                    return cur.rowcount
+                # TRUNCATE не сообщает число строк — считаем заранее
+                cur.execute("SELECT COUNT(*) FROM knowledge_base")
+                count = cur.fetchone()[0]
+                cur.execute("TRUNCATE knowledge_base, feedback")
+                return count
 
-        for row in rows:
-            do_insert(row)
-        cur.execute("SELECT COUNT(*) FROM knowledge_base")
-        total = cur.fetchone()[0]
-    print(f"Загружено записей из kb_test.xlsx: {len(rows)}")
-    print(f"Всего записей в knowledge_base: {total}")
+            try:
+                # COPY — один поток данных вместо отдельного INSERT на каждую строку
+                with conn.transaction():
+                    deleted = clear_kb(truncate=can_freeze)
+                    copy_sql = sql.SQL("COPY knowledge_base ({}) FROM STDIN{}").format(
+                        columns_sql, sql.SQL(" WITH (FREEZE)" if can_freeze else "")
+                    )
+                    with cur.copy(copy_sql) as cp:
+                        try:
+                            for row in parse_rows(rows_iter):
+                                cp.write_row(db_row(row))
+                                loaded += 1
+                        finally:
+                            # Книга больше не нужна — освобождаем её до завершения COPY,
+                            # пересборки индексов и возможного повторного чтения файла
+                            rows_iter.close()
+            except psycopg.Error as e:
+                print("(COPY не выполнен, вставка построчно:", e, ")")
+                deleted = clear_kb(truncate=False)
+                insert_sql = sql.SQL("INSERT INTO knowledge_base ({}) VALUES ({})").format(
+                    columns_sql, sql.SQL(", ").join(sql.Placeholder() * len(columns))
+                )
+                # Часть файла уже прочитана в COPY — читаем заново, без строки заголовков
+                fallback_rows = [db_row(row) for row in parse_rows(islice(_iter_xlsx_rows(KB_XLSX_PATH), 1, None))]
+                cur.executemany(insert_sql, fallback_rows)
+                loaded = len(fallback_rows)
+
+            if not loaded:
+                raise psycopg.Rollback(tx)
+
+            for name, stmt in rebuild_indexes:
+                print(f"Пересоздание индекса {name} ...")
+                cur.execute(stmt)
+        if not loaded:
+            # Транзакция откачена — в таблице осталась прежняя БЗ
+            cur.execute("SELECT COUNT(*) FROM knowledge_base")
+            print("В xlsx нет подходящих строк (заполнены вопрос и ответ).")
+            print(f"Записей в knowledge_base: {cur.fetchone()[0]}")
+            return
+    print(f"Удалено предыдущих записей в knowledge_base: {deleted}")
+    print(f"Загружено записей из kb_test.xlsx: {loaded}")
+    # Таблица очищалась в той же транзакции, так что всего записей ровно столько, сколько загружено
+    print(f"Всего записей в knowledge_base: {loaded}")
     print("В колонке tags сохранены шаблонные вопросы (примеры запросов, приводящих к этой теме).")
     if has_embedding:
         print("Колонка embedding оставлена NULL — заполните через POST /kb/refresh-embeddings или скрипт.")
 
 
+def _add_columns(
+    cur, table: str, columns: Iterable[tuple[str, str]], existing: Collection[str] = ()
+) -> None:
+    """
+    Недостающие колонки одним ALTER TABLE (одна блокировка и одно обновление каталога).
+    Колонки из existing (уже известные по каталогу) пропускаются; если добавлять нечего,
+    ALTER не выполняется вовсе. Если общий ALTER не прошёл — по одной колонке, как раньше.
+    """
+    columns = [(col, typ) for col, typ in columns if col not in existing]
+    if not columns:
+        return
+    clauses = ", ".join(f"ADD COLUMN IF NOT EXISTS {col} {typ}" for col, typ in columns)
+    try:
+        cur.execute(f"ALTER TABLE {table} {clauses};")
+        return
+    except Exception:
+        pass
+    for col, typ in columns:
+        try:
+            cur.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {col} {typ};")
+        except Exception:
+            pass
+
+
 def exec_many(conn: PgConnection, statements: Iterable[str], title: str) -> None:
     print(f"\n== {title} ==")
-    with conn.cursor() as cur:
+    # Pipeline: команды уходят на сервер без ожидания ответа на каждую.
+    # Одна транзакция (DDL в PostgreSQL транзакционен): один COMMIT и fsync WAL вместо
+    # отдельного на каждую команду, а при ошибке не остаётся половины схемы.
+    with conn.transaction(), conn.pipeline(), conn.cursor() as cur:
         for idx, stmt in enumerate(statements, start=1):
             short = stmt.strip().splitlines()[0][:90]
             print(f"[{idx}] {short} ...")
@@ -185,6 +329,34 @@ def exec_many(conn: PgConnection, statements: Iterable[str], title: str) -> None
     print("OK")
 
 
+_INDEX_TABLE_RE = re.compile(r"\bON\s+(\w+)", re.IGNORECASE)
+
+
+def create_indexes_parallel(conninfo: dict, statements: list[str], title: str, workers: int = 4) -> None:
+    """
+    Индексы разных таблиц строятся параллельно, каждая таблица — в своём соединении;
+    индексы одной таблицы идут по очереди, чтобы не спорить за её блокировки.
+    Pipeline здесь не используется: CREATE INDEX CONCURRENTLY в нём запрещён.
+    """
+    print(f"\n== {title} ==")
+    by_table: dict[str, list[str]] = {}
+    for stmt in statements:
+        m = _INDEX_TABLE_RE.search(stmt)
+        by_table.setdefault(m.group(1) if m else "", []).append(stmt)
+
+    def build(table_statements: list[str]) -> None:
+        with psycopg.connect(**conninfo, autocommit=True) as worker_conn, worker_conn.cursor() as cur:
+            cur.execute("SET max_parallel_maintenance_workers = 4; SET maintenance_work_mem = '256MB';")
+            for stmt in table_statements:
+                print(f"  {stmt.strip().splitlines()[0][:90]} ...")
+                cur.execute(stmt)
+
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        # list(): дождаться всех и пробросить первую ошибку
+        list(ex.map(build, by_table.values()))
+    print("OK")
+
+
 def ensure_database(
     host: str,
     port: int,
@@ -202,21 +374,28 @@ def ensure_database(
         user=user,
         password=password,
         dbname="postgres",
-        options="-c client_encoding=UTF8",
+        client_encoding="UTF8",
     )
     conn.autocommit = True
     try:
         with conn.cursor() as cur:
+            # Сначала проверка: PostgreSQL проверяет право CREATEDB раньше, чем существование базы,
+            # и роль без CREATEDB на существующей базе получила бы InsufficientPrivilege
             cur.execute("SELECT 1 FROM pg_database WHERE datname = %s", (db_name,))
             if cur.fetchone():
                 print(f"База {db_name!r} уже существует.")
                 return
 
-            cur.execute(
-                sql.SQL(
-                    "CREATE DATABASE {} WITH ENCODING 'UTF8' TEMPLATE template0"
-                ).format(sql.Identifier(db_name))
-            )
+            try:
+                cur.execute(
+                    sql.SQL(
+                        "CREATE DATABASE {} WITH ENCODING 'UTF8' TEMPLATE template0"
+                    ).format(sql.Identifier(db_name))
+                )
+            except psycopg.errors.DuplicateDatabase:
+                # Базу успел создать параллельный запуск между проверкой и CREATE
+                print(f"База {db_name!r} уже существует.")
+                return
             print(f"Создана база {db_name!r}.")
     finally:
         conn.close()
@@ -230,19 +409,21 @@ def create_schema(
     db_name: str,
     drop_existing: bool,
     seed: bool,
+    wipe_data: bool = False,
 ) -> None:
     host = str(host or "localhost").strip()
     user = str(user or "postgres").strip()
     password = str(password or "").strip()
     db_name = str(db_name or "test").strip()
-    conn = psycopg.connect(
-        host=host,
-        port=port,
-        user=user,
-        password=password,
-        dbname=db_name,
-        options="-c client_encoding=UTF8",
-    )
+    conninfo = {
+        "host": host,
+        "port": port,
+        "user": user,
+        "password": password,
+        "dbname": db_name,
+        "client_encoding": "UTF8",
+    }
+    conn = psycopg.connect(**conninfo)
     conn.autocommit = True
 
     try:
@@ -258,87 +439,135 @@ def create_schema(
                 ],
                 "Удаление старых таблиц",
             )
+        elif wipe_data:
+            # Схема остаётся (индексы, триггеры, ограничения), удаляются только данные:
+            # TRUNCATE освобождает файлы таблиц сразу, без пересоздания индексов
+            print("\n== Очистка данных ==")
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT array_agg(t) FROM unnest(%s::text[]) AS t WHERE to_regclass('public.' || t) IS NOT NULL",
+                    (["feedback", "email_log", "ai_run_log", "knowledge_base", "tickets", "operators"],),
+                )
+                tables = cur.fetchone()[0] or []
+                if tables:
+                    cur.execute(
+                        sql.SQL("TRUNCATE {} RESTART IDENTITY CASCADE").format(
+                            sql.SQL(", ").join(map(sql.Identifier, tables))
+                        )
+                    )
+            print("OK" if tables else "(таблиц нет)")
 
         # Расширения: pg_trgm всегда, vector (pgvector) — опционально
         vector_available = False
         with conn.cursor() as cur:
             print("\n== Расширения ==")
-            print("[1] CREATE EXTENSION IF NOT EXISTS pg_trgm ...")
-            cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
-            print("[2] CREATE EXTENSION IF NOT EXISTS vector ...")
-            try:
-                cur.execute("CREATE EXTENSION IF NOT EXISTS vector;")
+            # Сначала только чтение каталога: уже установленные расширения не трогаем,
+            # а vector не пытаемся создавать, если его нет на сервере
+            cur.execute(
+                "SELECT name, installed_version IS NOT NULL FROM pg_available_extensions "
+                "WHERE name IN ('pg_trgm', 'vector');"
+            )
+            extensions = dict(cur.fetchall())
+            if extensions.get("pg_trgm"):
+                print("[1] pg_trgm уже установлен")
+            else:
+                print("[1] CREATE EXTENSION IF NOT EXISTS pg_trgm ...")
+                cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+            if "vector" not in extensions:
+                print("[2] (пропущено: pgvector не установлен — колонка embedding не будет создана)")
+            elif extensions["vector"]:
                 vector_available = True
-                print("OK (pgvector)")
-            except Exception as e:
-                if "vector" in str(e).lower():
-                    print("(пропущено: pgvector не установлен — колонка embedding не будет создана)")
-                else:
-                    raise
+                print("[2] pgvector уже установлен")
+            else:
+                print("[2] CREATE EXTENSION IF NOT EXISTS vector ...")
+                try:
+                    cur.execute("CREATE EXTENSION IF NOT EXISTS vector;")
+                    vector_available = True
+                    print("OK (pgvector)")
+                except Exception as e:
+                    if "vector" in str(e).lower():
+                        print("(пропущено: pgvector не установлен — колонка embedding не будет создана)")
+                    else:
+                        raise
 
         # Если таблица tickets уже создана (например backend/db.py) без колонок tags/category/search_vector —
         # добавляем их до создания индексов (только если таблица уже есть).
         with conn.cursor() as cur:
-            cur.execute("""
-                SELECT 1 FROM information_schema.tables
-                WHERE table_schema = 'public' AND table_name = 'tickets';
-            """)
-            if cur.fetchone():
-                for col, typ in (
-                    ("tags", "TEXT[]"),
-                    ("category", "VARCHAR(100)"),
-                    ("operator_id", "INTEGER REFERENCES operators(id) ON DELETE SET NULL"),
-                    ("ai_processing_time", "INTEGER"),
-                    ("ai_model", "VARCHAR(50)"),
-                ):
-                    try:
-                        cur.execute(
-                            f"ALTER TABLE tickets ADD COLUMN IF NOT EXISTS {col} {typ};"
-                        )
-                    except Exception:
-                        pass
+            # Существование таблиц и их колонки — одним запросом по каталогу,
+            # без представлений information_schema
+            cur.execute(
+                """
+                SELECT c.relname, array_agg(a.attname::text)
+                FROM pg_class c
+                JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+                WHERE c.oid IN (to_regclass('public.tickets'), to_regclass('public.knowledge_base'))
+                GROUP BY c.relname;
+                """
+            )
+            table_columns = {name: set(cols) for name, cols in cur.fetchall()}
+            tickets_exists = "tickets" in table_columns
+            kb_exists = "knowledge_base" in table_columns
+            if tickets_exists:
+                _add_columns(
+                    cur,
+                    "tickets",
+                    (
+                        ("tags", "TEXT[]"),
+                        ("category", "VARCHAR(100)"),
+                        ("operator_id", "INTEGER REFERENCES operators(id) ON DELETE SET NULL"),
+                        ("ai_processing_time", "INTEGER"),
+                        ("ai_model", "VARCHAR(50)"),
+                    ),
+                    table_columns["tickets"],
+                )
                 try:
-                    cur.execute("""
-                        ALTER TABLE tickets ADD COLUMN IF NOT EXISTS search_vector tsvector
-                        GENERATED ALWAYS AS (
-                            setweight(to_tsvector('simple', coalesce(question,'')), 'A') ||
-                            setweight(to_tsvector('simple', coalesce(answer,'')), 'B')
-                        ) STORED;
-                    """)
+                    if "search_vector" not in table_columns["tickets"]:
+                        cur.execute("ALTER TABLE tickets ADD COLUMN IF NOT EXISTS search_vector tsvector;")
+                    for stmt in search_vector_statements("tickets", "russian", "question", "answer"):
+                        cur.execute(stmt)
+                    if "search_vector" not in table_columns["tickets"]:
+                        # Колонка добавлена пустой, а триггер с 'russian' мог уже быть — бэкфилл явно
+                        cur.execute(search_vector_backfill("tickets", "russian", "question", "answer"))
                 except Exception:
                     pass
 
             # Если knowledge_base уже создана (например backend/db.py) без search_vector/keywords — добавляем.
-            cur.execute("""
-                SELECT 1 FROM information_schema.tables
-                WHERE table_schema = 'public' AND table_name = 'knowledge_base';
-            """)
-            if cur.fetchone():
-                for col, typ in (
-                    ("keywords", "TEXT[]"),
-                    ("success_rate", "FLOAT DEFAULT 1.0"),
-                ):
+            if kb_exists:
+                _add_columns(
+                    cur,
+                    "knowledge_base",
+                    (
+                        ("keywords", "TEXT[]"),
+                        ("success_rate", "FLOAT DEFAULT 1.0"),
+                    ),
+                    table_columns["knowledge_base"],
+                )
+                # search_vector с конфигом 'russian' для морфологии и стемминга.
+                # Если колонка уже обычная (не GENERATED) и триггер считает её с 'russian' —
+                # пересоздавать нечего: DROP/ADD COLUMN переписал бы таблицу и индекс GIN.
+                cur.execute(
+                    """
+                    SELECT a.attgenerated = '' AND COALESCE(p.prosrc LIKE '%''russian''%', FALSE)
+                    FROM pg_attribute a
+                    LEFT JOIN pg_proc p ON p.proname = 'knowledge_base_search_vector_update'
+                    WHERE a.attrelid = 'public.knowledge_base'::regclass
+                      AND a.attname = 'search_vector' AND NOT a.attisdropped;
+                    """
+                )
+                kb_search_row = cur.fetchone()
+                if not (kb_search_row and kb_search_row[0]):
                     try:
-                        cur.execute(
-                            f"ALTER TABLE knowledge_base ADD COLUMN IF NOT EXISTS {col} {typ};"
-                        )
-                    except Exception:
-                        pass
-                # search_vector с конфигом 'russian' для морфологии и стемминга
-                try:
-                    cur.execute("DROP INDEX IF EXISTS idx_kb_search;")
-                    cur.execute("ALTER TABLE knowledge_base DROP COLUMN IF EXISTS search_vector;")
-                    cur.execute("""
-                        ALTER TABLE knowledge_base ADD COLUMN search_vector tsvector
-                        GENERATED ALWAYS AS (
-                            setweight(to_tsvector('russian', coalesce(title,'')), 'A') ||
-                            setweight(to_tsvector('russian', coalesce(content,'')), 'B')
-                        ) STORED;
-                    """)
-                    cur.execute("CREATE INDEX IF NOT EXISTS idx_kb_search ON knowledge_base USING GIN (search_vector);")
-                except Exception as e:
-                    print("(search_vector для knowledge_base:", e, ")")
-                if vector_available:
+                        cur.execute("DROP INDEX IF EXISTS idx_kb_search;")
+                        cur.execute("ALTER TABLE knowledge_base DROP COLUMN IF EXISTS search_vector;")
+                        cur.execute("ALTER TABLE knowledge_base ADD COLUMN search_vector tsvector;")
+                        for stmt in search_vector_statements("knowledge_base", "russian", "title", "content"):
+                            cur.execute(stmt)
+                        # Колонка пересоздана пустой, а триггер с 'russian' мог уже быть — бэкфилл явно
+                        cur.execute(search_vector_backfill("knowledge_base", "russian", "title", "content"))
+                        cur.execute("CREATE INDEX IF NOT EXISTS idx_kb_search ON knowledge_base USING GIN (search_vector);")
+                    except Exception as e:
+                        print("(search_vector для knowledge_base:", e, ")")
+                if vector_available and "embedding" not in table_columns["knowledge_base"]:
                     try:
                         cur.execute(
                             "ALTER TABLE knowledge_base ADD COLUMN IF NOT EXISTS embedding vector(384);"
@@ -383,18 +612,21 @@ def create_schema(
                 processed_at TIMESTAMP,
                 resolved_at TIMESTAMP,
                 updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                search_vector tsvector GENERATED ALWAYS AS (
-                    setweight(to_tsvector('simple', coalesce(question,'')), 'A') ||
-                    setweight(to_tsvector('simple', coalesce(answer,'')), 'B')
-                ) STORED
+                search_vector tsvector
             );
             """,
-            "CREATE INDEX IF NOT EXISTS idx_tickets_status ON tickets(status);",
+            *search_vector_statements("tickets", "russian", "question", "answer"),
             "CREATE INDEX IF NOT EXISTS idx_tickets_client_email ON tickets(client_email);",
             "CREATE INDEX IF NOT EXISTS idx_tickets_created_at ON tickets(created_at DESC);",
+            "CREATE INDEX IF NOT EXISTS idx_tickets_status_created_at ON tickets(status, created_at DESC);",
             "CREATE INDEX IF NOT EXISTS idx_tickets_resolved_at ON tickets(resolved_at DESC);",
-            "CREATE INDEX IF NOT EXISTS idx_tickets_is_resolved ON tickets(is_resolved);",
-            "CREATE INDEX IF NOT EXISTS idx_tickets_needs_attention ON tickets(needs_attention);",
+            # Вместо полных индексов по булевым флагам и по status (префикс status_created_at) —
+            # частичные: в них только открытые / требующие внимания тикеты, малая доля таблицы
+            "DROP INDEX IF EXISTS idx_tickets_status;",
+            "DROP INDEX IF EXISTS idx_tickets_is_resolved;",
+            "DROP INDEX IF EXISTS idx_tickets_needs_attention;",
+            "CREATE INDEX IF NOT EXISTS idx_tickets_open ON tickets(created_at DESC) WHERE is_resolved = FALSE;",
+            "CREATE INDEX IF NOT EXISTS idx_tickets_attn ON tickets(created_at DESC) WHERE needs_attention = TRUE;",
             "CREATE INDEX IF NOT EXISTS idx_tickets_tags ON tickets USING GIN (tags);",
             "CREATE INDEX IF NOT EXISTS idx_tickets_search ON tickets USING GIN (search_vector);",
             """
@@ -415,35 +647,15 @@ def create_schema(
             "CREATE INDEX IF NOT EXISTS idx_email_log_ticket ON email_log(ticket_id);",
             "CREATE INDEX IF NOT EXISTS idx_email_log_message_id ON email_log(message_id);",
             "CREATE INDEX IF NOT EXISTS idx_email_log_direction ON email_log(direction);",
-            "CREATE INDEX IF NOT EXISTS idx_email_log_created ON email_log(created_at DESC);",
-            (
-                """
-            CREATE TABLE IF NOT EXISTS knowledge_base (
-                id SERIAL PRIMARY KEY,
-                title VARCHAR(500) NOT NULL,
-                content TEXT NOT NULL,
-                short_answer TEXT,
-                tags TEXT[],
-                category VARCHAR(100),
-                """
-                + ("embedding vector(384),\n                " if vector_available else "")
-                + """keywords TEXT[],
-                usage_count INTEGER DEFAULT 0,
-                success_rate FLOAT DEFAULT 1.0,
-                is_active BOOLEAN DEFAULT TRUE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                search_vector tsvector GENERATED ALWAYS AS (
-                    setweight(to_tsvector('russian', coalesce(title,'')), 'A') ||
-                    setweight(to_tsvector('russian', coalesce(content,'')), 'B')
-                ) STORED
-            );
-            """
-            ),
-            "CREATE INDEX IF NOT EXISTS idx_kb_tags ON knowledge_base USING GIN (tags);",
+            # email_log только дописывается: created_at растёт вместе с физическим порядком строк,
+            # BRIN в сотни раз меньше btree и почти не стоит ничего на вставке
+            "DROP INDEX IF EXISTS idx_email_log_created;",
+            "CREATE INDEX IF NOT EXISTS idx_email_log_created_brin ON email_log USING BRIN (created_at) WITH (pages_per_range = 32);",
+            KB_CREATE_WITH_VECTOR if vector_available else KB_CREATE_NO_VECTOR,
+            *search_vector_statements("knowledge_base", "russian", "title", "content"),
+            *(stmt for _, stmt in KB_GIN_INDEXES),
             "CREATE INDEX IF NOT EXISTS idx_kb_category ON knowledge_base(category);",
             "CREATE INDEX IF NOT EXISTS idx_kb_is_active ON knowledge_base(is_active);",
-            "CREATE INDEX IF NOT EXISTS idx_kb_search ON knowledge_base USING GIN (search_vector);",
             "CREATE INDEX IF NOT EXISTS idx_kb_usage ON knowledge_base(usage_count DESC);",
             """
             CREATE TABLE IF NOT EXISTS feedback (
@@ -462,7 +674,31 @@ def create_schema(
             "CREATE INDEX IF NOT EXISTS idx_feedback_helpful ON feedback(is_helpful);",
         ]
 
-        exec_many(conn, schema_statements, "Создание таблиц и индексов")
+        # На заполненной БД индексы строим CONCURRENTLY, чтобы не блокировать запись в таблицы
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT COALESCE(bool_or(reltuples > 0 OR relpages > 0), FALSE)
+                FROM pg_class
+                WHERE oid IN (
+                    to_regclass('public.tickets'), to_regclass('public.knowledge_base'),
+                    to_regclass('public.email_log'), to_regclass('public.feedback')
+                );
+            """)
+            populated = cur.fetchone()[0]
+        if populated:
+            index_statements = [st for st in schema_statements if st.lstrip().startswith("CREATE INDEX IF NOT EXISTS")]
+            exec_many(
+                conn,
+                [st for st in schema_statements if st not in index_statements],
+                "Создание таблиц",
+            )
+            create_indexes_parallel(
+                conninfo,
+                [st.replace("CREATE INDEX IF NOT EXISTS", "CREATE INDEX CONCURRENTLY IF NOT EXISTS", 1) for st in index_statements],
+                "Создание индексов (CONCURRENTLY)",
+            )
+        else:
+            exec_many(conn, schema_statements, "Создание таблиц и индексов")
 
         # Индекс для векторного поиска (семантика)
         if vector_available:
@@ -478,19 +714,18 @@ def create_schema(
 
         # Добавить колонки, если таблица создана старым скриптом без них
         with conn.cursor() as cur:
-            for col, typ in (
-                ("ai_category", "VARCHAR(100)"),
-                ("ai_priority", "VARCHAR(50)"),
-                ("ai_tone", "VARCHAR(50)"),
-                ("message_id", "VARCHAR(255)"),
-                ("in_reply_to", "VARCHAR(255)"),
-            ):
-                try:
-                    cur.execute(
-                        f"ALTER TABLE tickets ADD COLUMN IF NOT EXISTS {col} {typ};"
-                    )
-                except Exception:
-                    pass
+            _add_columns(
+                cur,
+                "tickets",
+                (
+                    ("ai_category", "VARCHAR(100)"),
+                    ("ai_priority", "VARCHAR(50)"),
+                    ("ai_tone", "VARCHAR(50)"),
+                    ("message_id", "VARCHAR(255)"),
+                    ("in_reply_to", "VARCHAR(255)"),
+                ),
+                table_columns.get("tickets", ()),
+            )
             try:
                 cur.execute(
                     "CREATE UNIQUE INDEX IF NOT EXISTS idx_tickets_message_id ON tickets (message_id) WHERE message_id IS NOT NULL;"
@@ -599,11 +834,22 @@ def create_schema(
                   );
                 """,
             ]
-            exec_many(conn, seed_statements, "Тестовые данные")
+            print("\n== Тестовые данные ==")
+            # Один запрос из нескольких команд (без параметров psycopg шлёт его
+            # простым протоколом) в одной транзакции: одна пересылка и никаких
+            # наполовину заполненных таблиц при ошибке
+            with conn.transaction(), conn.cursor() as cur:
+                cur.execute("SET LOCAL synchronous_commit = off;\n" + "\n".join(seed_statements))
+            print("OK")
 
             # Заполнение knowledge_base из kb_test.xlsx (предыдущая вставка удаляется)
             _seed_kb_from_xlsx(conn)
 
+            # Статистика для планировщика сразу, не дожидаясь autovacuum: первые запросы
+            # к только что заполненным таблицам получают нормальные планы
+            with conn.cursor() as cur:
+                cur.execute("ANALYZE operators, knowledge_base, tickets, email_log, feedback;")
+
         print("\nГотово. База и таблицы созданы.")
     finally:
         conn.close()
@@ -632,6 +878,11 @@ def main() -> int:
         action="store_true",
         help="Удалить существующие таблицы перед созданием",
     )
+    parser.add_argument(
+        "--wipe-data",
+        action="store_true",
+        help="Очистить данные (TRUNCATE), сохранив схему и индексы; игнорируется при --drop-existing",
+    )
     parser.add_argument(
         "--seed",
         action="store_true",
@@ -659,6 +910,7 @@ def main() -> int:
             db_name=args.db,
             drop_existing=args.drop_existing,
             seed=args.seed,
+            wipe_data=args.wipe_data,
         )
         return 0
     except Exception as exc:
@@ -14,23 +14,26 @@ def main():
         user=os.getenv("PGUSER", "postgres"),
         password=os.getenv("PGPASSWORD"),
         dbname=os.getenv("PGDATABASE", "test"),
-        options="-c client_encoding=UTF8",
+        client_encoding="UTF8",
     )
     cur = conn.cursor()
-    cur.execute("""
-        SELECT id, title, category, left(content, 120) as content_preview,
-               array_length(tags, 1) as tags_count
-        FROM knowledge_base ORDER BY id
-    """)
-    rows = cur.fetchall()
+    cur.execute("SELECT count(*) FROM knowledge_base")
+    total = cur.fetchone()[0]
     out = sys.stdout
     out.reconfigure(encoding="utf-8")
-    out.write(f"knowledge_base: {len(rows)} записей\n\n")
-    for r in rows:
-        id_, title, category, content_preview, tags_count = r
-        out.write(f"id={id_} category={category or ''} tags={tags_count or 0}\n")
-        out.write(f"  title: {title}\n")
-        out.write(f"  content: {(content_preview or '')[:100]}...\n\n")
+    out.write(f"knowledge_base: {total} записей\n\n")
+    # Серверный курсор: строки приходят пачками по itersize, вся БЗ в памяти не держится.
+    # Текст каждой записи собирается на сервере — в Python остаётся только вывод.
+    with conn.cursor(name="kb_stream") as kb_cur:
+        kb_cur.itersize = 500
+        kb_cur.execute("""
+            SELECT format(
+                E'id=%s category=%s tags=%s\n  title: %s\n  content: %s...\n\n',
+                id, category, coalesce(array_length(tags, 1), 0), title, left(content, 100)
+            )
+            FROM knowledge_base ORDER BY id
+        """)
+        out.writelines(r[0] for r in kb_cur)
     cur.execute("SELECT column_name, data_type FROM information_schema.columns WHERE table_name = 'knowledge_base' ORDER BY ordinal_position")
     out.write("Колонки таблицы knowledge_base:\n")
     for r in cur.fetchall():
@@ -4,9 +4,13 @@ Invoke-задачи: запуск проекта, инициализация Б
 Запуск: invoke up && invoke init-db && invoke test
 Или одной командой: invoke run
 """
+import http.client
+import json
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from urllib.parse import urlencode
 
 from invoke import task
 
@@ -29,8 +33,29 @@ def up(c):
         except ImportError:
             pass
     _cd_run(c, "docker compose up -d --build", pty=False)
-    print("Ждём готовности сервисов (15 сек)...")
-    time.sleep(15)
+    _wait_for_health()
+
+
+def _wait_for_health(timeout: float = 60.0) -> bool:
+    """Опрашивать GET /health с нарастающей паузой (0.25 → 2 сек), пока backend не ответит 200."""
+    print("Ждём готовности сервисов", end="", flush=True)
+    conn = http.client.HTTPConnection("localhost", 8000, timeout=5)
+    deadline = time.monotonic() + timeout
+    delay = 0.25
+    try:
+        while True:
+            code, _ = _http_request(conn, "GET", "/health")
+            if code == 200:
+                print(" OK")
+                return True
+            if time.monotonic() + delay > deadline:
+                print(f" не дождались за {timeout:.0f} сек")
+                return False
+            print(".", end="", flush=True)
+            time.sleep(delay)
+            delay = min(delay * 2, 2.0)
+    finally:
+        conn.close()
 
 
 @task
@@ -43,10 +68,11 @@ def down(c, volumes=False):
 
 
 @task
-def init_db(c, drop=False):
+def init_db(c, drop=False, wipe=False):
     """
     Инициализировать БД и заполнить из kb_test.xlsx.
     Использует backend/.env, подключается к localhost:5432 (проброс из Docker).
+    invoke init-db --wipe — очистить данные, не пересоздавая таблицы и индексы.
     """
     os.chdir(ROOT)
     env = os.environ.copy()
@@ -56,33 +82,23 @@ def init_db(c, drop=False):
     cmd = "python init_database.py --seed"
     if drop:
         cmd += " --drop-existing"
+    elif wipe:
+        cmd += " --wipe-data"
     c.run(cmd, pty=False, env=env)
 
 
-def _http_get(url: str) -> tuple[int, str]:
-    """GET запрос (urllib), возвращает (status_code, text)."""
-    import urllib.request
-    try:
-        req = urllib.request.Request(url)
-        with urllib.request.urlopen(req, timeout=10) as r:
-            return r.status, r.read().decode("utf-8", errors="replace")
-    except Exception as e:
-        return 0, str(e)
-
-
-def _http_post(url: str, data: str) -> tuple[int, str]:
-    """POST JSON (urllib), возвращает (status_code, text)."""
-    import urllib.request
+def _http_request(
+    conn: http.client.HTTPConnection, method: str, path: str, data: str | None = None
+) -> tuple[int, str]:
+    """Запрос по общему соединению (keep-alive), возвращает (status_code, text)."""
     try:
-        req = urllib.request.Request(
-            url,
-            data=data.encode("utf-8"),
-            headers={"Content-Type": "application/json"},
-            method="POST",
-        )
-        with urllib.request.urlopen(req, timeout=30) as r:
-            return r.status, r.read().decode("utf-8", errors="replace")
+        headers = {"Content-Type": "application/json"} if data is not None else {}
+        conn.request(method, path, body=data.encode("utf-8") if data is not None else None, headers=headers)
+        r = conn.getresponse()
+        return r.status, r.read().decode("utf-8", errors="replace")
     except Exception as e:
+        # Сломанное соединение закрываем — следующий запрос откроет новое
+        conn.close()
         return 0, str(e)
 
 
@@ -91,39 +107,54 @@ def test(c):
     """
     Проверить API: health, поиск по БЗ, ответ через /kb/ask.
     """
-    base = "http://localhost:8000"
-    print("1. GET /health")
-    code, _ = _http_get(f"{base}/health")
-    if code != 200:
-        print(f"   Ошибка: health вернул {code}")
-        return
-    print("   OK")
-
-    print("2. GET /kb/search?q=пароль&limit=2")
-    code, out = _http_get(f"{base}/kb/search?q=пароль&limit=2")
-    if code != 200 or "entries" not in out:
-        print(f"   Предупреждение: код {code}, нет entries (пустая БЗ?)")
-    else:
+    # /health — на общем соединении; /kb/search и /kb/ask независимы и идут параллельно,
+    # каждый по своему соединению (http.client не потокобезопасен), печать — по порядку
+    conn = http.client.HTTPConnection("localhost", 8000, timeout=30)
+    ask_conn = http.client.HTTPConnection("localhost", 8000, timeout=30)
+    try:
+        print("1. GET /health")
+        code, _ = _http_request(conn, "GET", "/health")
+        if code != 200:
+            print(f"   Ошибка: health вернул {code}")
+            return
         print("   OK")
 
-    print("3. POST /kb/ask")
-    code, out = _http_post(
-        f"{base}/kb/ask",
-        '{"question": "Как установить пароль?", "limit": 3}',
-    )
-    if code != 200 or "answer" not in out:
-        print(f"   Предупреждение: код {code}, нет answer")
-    else:
-        print("   OK")
-        # Показать начало ответа
-        import json
-        try:
-            d = json.loads(out)
-            ans = (d.get("answer") or "")[:200]
-            if ans:
-                print(f"   Ответ: {ans}...")
-        except Exception:
-            pass
+        with ThreadPoolExecutor(max_workers=2) as ex:
+            search = ex.submit(
+                _http_request, conn, "GET", "/kb/search?" + urlencode({"q": "пароль", "limit": 2})
+            )
+            ask = ex.submit(
+                _http_request,
+                ask_conn,
+                "POST",
+                "/kb/ask",
+                '{"question": "Как установить пароль?", "limit": 3}',
+            )
+
+            print("2. GET /kb/search?q=пароль&limit=2")
+            code, out = search.result()
+            if code != 200 or "entries" not in out:
+                print(f"   Предупреждение: код {code}, нет entries (пустая БЗ?)")
+            else:
+                print("   OK")
+
+            print("3. POST /kb/ask")
+            code, out = ask.result()
+        if code != 200 or "answer" not in out:
+            print(f"   Предупреждение: код {code}, нет answer")
+        else:
+            print("   OK")
+            # Показать начало ответа
+            try:
+                d = json.loads(out)
+                ans = (d.get("answer") or "")[:200]
+                if ans:
+                    print(f"   Ответ: {ans}...")
+            except Exception:
+                pass
+    finally:
+        conn.close()
+        ask_conn.close()
 
     print("\nГотово. Открой http://localhost:8000/docs для полного API.")
 